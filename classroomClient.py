@@ -0,0 +1,53 @@
+# coding: UTF-8
+# classroomClient.py
+# thin client for "classroomManagement.py serve"
+# (標準ライブラリのみを import し、起動コストを最小にする)
+import json
+import os
+import socket
+import sys
+import tempfile
+
+__doc__ = """classroomClient.py
+
+Usage:
+    classroomClient.py [--socket=<path>] <subcommand> [<args>...]
+
+    send subcommand of classroomManagement.py (lists, crawl, enroll, ...)
+    to the running "classroomManagement.py serve" process.
+"""
+
+
+def main(argv):
+    """main(argv)
+    """
+    _socket_file = os.path.join(
+        tempfile.gettempdir(), "classroomManagement-{0}.sock".format(os.getuid()))
+    if argv and argv[0].startswith("--socket="):
+        _socket_file = argv[0].split("=", 1)[1]
+        argv = argv[1:]
+    if not argv or argv[0] in ("-h", "--help"):
+        print(__doc__)
+        return 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _s:
+        try:
+            _s.connect(_socket_file)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print("classroomManagement.py serve is not running ({0})".format(
+                _socket_file), file=sys.stderr)
+            return 1
+        _s.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+                   .encode("UTF-8"))
+        with _s.makefile("r", encoding="UTF-8") as _f:
+            for line in _f:
+                message = json.loads(line)
+                if "out" in message:
+                    sys.stdout.write(message["out"])
+                    sys.stdout.flush()
+                else:
+                    return message.get("exit", 0)
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
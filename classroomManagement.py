@@ -5,10 +5,23 @@ import sys
 import csv
 import re
 import configparser
+import time
+import hashlib
+import bisect
+import sqlite3
+import math
+import socketserver
+import tempfile
+import traceback
+import io
+import threading
+import queue
+from contextlib import redirect_stdout, redirect_stderr
+from collections import deque
 # Python 3.12 で multiprocessing.pool の内部 API (_get_tasks 等) が削除されたため、
 # istarmap (Pool.istarmap のモンキーパッチ) から concurrent.futures.ProcessPoolExecutor に移行。
 # worker 関数はグローバル変数への依存をなくし、必要な引数をすべて明示的に受け取る設計に変更。
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import partial
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
@@ -20,23 +33,33 @@ from tqdm import tqdm
 import json
 
 _prog = os.path.basename(__file__)
+# Classroom services reused in each worker process and thread (get_service)
+_worker_services = threading.local()
+# threads issuing the independent list chains of one course (crawl_classroom_proc)
+_worker_threads = None
 
 __doc__ = f"""{_prog}
 
 Usage:
-    {_prog} all [--dry-run] [--teacher] [--foreign-domain] [--debug]
+    {_prog} all [--dry-run] [--teacher] [--foreign-domain] [--sharded] [--from-snapshot=<snapshotDb>] [--debug]
     {_prog} create [<classFile>] [--with-activate] [--dry-run] [--debug]
-    {_prog} enroll [<enrollFile>] [<coursesFile>] [--dry-run] [--teacher] [--foreign-domain] [--debug]
-    {_prog} unenroll <userId> <courses>... [--dry-run] [--debug]
-    {_prog} remove <courses>... [--dry-run] [--debug]
-    {_prog} lists <outputCsv> [--all-states] [--all-courses] [--debug]
-    {_prog} info <courses>... [--detail] [--debug]
+    {_prog} enroll [<enrollFile>] [<coursesFile>] [--since=<previousFile>] [--with-drop] [--dry-run] [--teacher] [--foreign-domain] [--sharded] [--shard=<slice>] [--from-snapshot=<snapshotDb>] [--debug]
+    {_prog} unenroll (<userId> <courses>... | --from-file=<unenrollFile>) [--dry-run] [--debug]
+    {_prog} remove (<courses>... | --from-file=<courseFile>) [--dry-run] [--debug]
+    {_prog} lists <outputCsv> [--all-states] [--all-courses] [--teachers=<teacherFile>] [--sharded] [--from-snapshot=<snapshotDb>] [--debug]
+    {_prog} info <courses>... [--detail] [--from-snapshot=<snapshotDb>] [--debug]
     {_prog} user <userId>
-    {_prog} crawl <coursesFile> <outputCsv> [--debug]
-    {_prog} get-stream <coursesFile> <keyword> <outputCsv>
-    {_prog} archive <courses>... [--dry-run] [--debug]
-    {_prog} active <courses>... [--dry-run] [--debug]
-    {_prog} owner <owner> <courses>... [--dry-run] [--debug]
+    {_prog} crawl <coursesFile> <outputCsv> [--watch=<interval>] [--sharded] [--shard=<slice>] [--from-snapshot=<snapshotDb>] [--debug]
+    {_prog} crawl <outputCsv> [--watch=<interval>] [--sharded] [--shard=<slice>] [--from-snapshot=<snapshotDb>] [--debug]
+    {_prog} get-stream <coursesFile> <keyword> <outputCsv> [--sharded] [--shard=<slice>]
+    {_prog} get-stream <keyword> <outputCsv> [--sharded] [--shard=<slice>]
+    {_prog} merge <outputCsv> <shardFiles>...
+    {_prog} archive (<courses>... | --from-file=<courseFile>) [--dry-run] [--debug]
+    {_prog} active (<courses>... | --from-file=<courseFile>) [--dry-run] [--debug]
+    {_prog} owner <owner> (<courses>... | --from-file=<courseFile>) [--dry-run] [--debug]
+    {_prog} snapshot <snapshotDb> [--sharded] [--debug]
+    {_prog} serve [--socket=<path>] [--sharded] [--debug]
+    {_prog} registry (import | export) <csvFile> [--debug]
     {_prog} -h | --help
 
 Options:
@@ -46,32 +69,54 @@ Options:
     enroll      enroll users on courses (default: enrollments.csv).
                 --teacher: invite / enroll Teacher role(default Student role)
                 --foreign-domain: force invite mode
+                --since: enroll only pairs added since previous enrollments file
+                         (or saved state; enrollStateFile in config.ini)
+                --with-drop: also unenroll pairs dropped since previous file
     unenroll    unenroll user from courses(course_id1, course_id2, ...).
+                --from-file: read (user id, course id) pairs from csv file
     remove      remove courses from classroom(course_id1 course_id2 ... ).
+                --from-file: read course ids (or class codes) from file, one per line
     lists       lists of all active courses
                 --all-states: include provision and archived courses
                 --all-courses: include courses not matching name formats
+                --teachers: list courses per teacher id in file (one per line)
     info        information of course information.
                 --detail: include course enrolled / invited students information.
     user        information of user.
     crawl       display situations of students registration.
+                (crawl / get-stream: courses in the registry unless <coursesFile> is given)
+                --watch: recheck only updated / hot courses every <interval> sec
+                         and append changed rows with deltas ("-": stdout)
     get-stream  get courses stream(announcements) with [keyword]
     archive     change courses(course_id1, course_id2, ...) state to ARCHIVE.
     active      change courses(course_id1, course_id2, ...) state to ACTIVE.
     owner       change owner of courses(course_id1, course_i2, ...)
+                --from-file: read course ids (or class codes) from file, one per line
+    snapshot    save all courses, teachers, students, invitations and profiles to SQLite db.
+    registry    import / export course registry(coursesID.db) from / to csv file.
+    merge       combine shard outputs(crawl / get-stream csv, enroll state) into one file.
+    serve       keep credentials, worker pool and caches warm, and run subcommands
+                sent by classroomClient.py over the unix socket(--socket).
+    --sharded   distribute course works over admin credentials(tokenFiles in config.ini)
+    --shard=<i/N>  process only slice i(0..N-1) of courses for running on N hosts;
+                outputs(and enroll state) are written as <name>.shard<i>of<N>.csv
+    --from-snapshot: lists / crawl / info read the snapshot db instead of API (offline)
+                all / enroll --dry-run count enrollments in the snapshot as satisfied
+                (all / enroll accept it only with --dry-run)
+    --dry-run   estimate API calls and time of create / enroll / all (no API access)
     -h --help   Show this screen and exit.
 """
 
 
-def parse_options():
-    """parse_options(void)
+def parse_options(argv=None):
+    """parse_options(argv=None)
     """
     _options = {}
-    args = docopt(__doc__)
+    args = docopt(__doc__, argv=argv)
 
     _options["classFile"] = args["<classFile>"] if args["<classFile>"] else "classes.csv"
     _options["enrollFile"] = args["<enrollFile>"] if args["<enrollFile>"] else "enrollments.csv"
-    _options["courseIdFile"] = args["<coursesFile>"] if args["<coursesFile>"] else "coursesID.csv"
+    _options["courseIdFile"] = args["<coursesFile>"]
     if args["create"]:
         _exec_mode = "create"
         _options["courseActivate"] = bool(args["--with-activate"])
@@ -79,17 +124,25 @@ def parse_options():
         _exec_mode = "enroll"
         _options["teacherRole"] = bool(args["--teacher"])
         _options["foreignDomain"] = bool(args["--foreign-domain"])
+        _options["since"] = args["--since"]
+        _options["withDrop"] = bool(args["--with-drop"])
     elif args["unenroll"]:
         _exec_mode = "unenroll"
-        _options["userId"] = args["<userId>"]
-        _options["courses"] = args["<courses>"]
+        if args["--from-file"]:
+            _options["unenrollments"] = read_unenroll_file(args["--from-file"])
+        else:
+            _options["unenrollments"] = [(args["<userId>"], _course)
+                                         for _course in args["<courses>"]]
     elif args["remove"]:
         _exec_mode = "remove"
-        _options["courses"] = args["<courses>"]
+        _options["courses"] = read_course_file(args["--from-file"]) \
+            if args["--from-file"] else args["<courses>"]
     elif args["lists"]:
         _exec_mode = "lists"
         _options["listAllStates"] = bool(args["--all-states"])
         _options["listAllCourses"] = bool(args["--all-courses"])
+        _options["teacherIds"] = read_course_file(args["--teachers"]) \
+            if args["--teachers"] else None
         _options["outputCsv"] = args["<outputCsv>"]
     elif args["info"]:
         _exec_mode = "info"
@@ -101,24 +154,60 @@ def parse_options():
     elif args["crawl"]:
         _exec_mode = "crawl"
         _options["outputCsv"] = args["<outputCsv>"]
+        _options["watch"] = args["--watch"]
     elif args["get-stream"]:
         _exec_mode = "getStream"
         _options["keyword"] = args["<keyword>"]
         _options["outputCsv"] = args["<outputCsv>"]
     elif args["archive"]:
         _exec_mode = "archive"
-        _options["courses"] = args["<courses>"]
+        _options["courses"] = read_course_file(args["--from-file"]) \
+            if args["--from-file"] else args["<courses>"]
     elif args["active"]:
         _exec_mode = "active"
-        _options["courses"] = args["<courses>"]
+        _options["courses"] = read_course_file(args["--from-file"]) \
+            if args["--from-file"] else args["<courses>"]
     elif args["owner"]:
         _exec_mode = "owner"
         _options["owner"] = args["<owner>"]
-        _options["courses"] = args["<courses>"]
+        _options["courses"] = read_course_file(args["--from-file"]) \
+            if args["--from-file"] else args["<courses>"]
+    elif args["snapshot"]:
+        _exec_mode = "snapshot"
+        _options["snapshotFile"] = args["<snapshotDb>"]
+    elif args["merge"]:
+        _exec_mode = "merge"
+        _options["outputCsv"] = args["<outputCsv>"]
+        _options["shardFiles"] = args["<shardFiles>"]
+    elif args["registry"]:
+        _exec_mode = "registry"
+        _options["registryAction"] = "import" if args["import"] else "export"
+        _options["csvFile"] = args["<csvFile>"]
+    elif args["serve"]:
+        _exec_mode = "serve"
+        _options["socket"] = args["--socket"] or os.path.join(
+            tempfile.gettempdir(), "classroomManagement-{0}.sock".format(os.getuid()))
     elif args["all"]:
         _exec_mode = "default"
+        _options["courseActivate"] = False
+        _options["teacherRole"] = bool(args["--teacher"])
+        _options["foreignDomain"] = bool(args["--foreign-domain"])
     # print(_exec_mode)
+    _options["sharded"] = bool(args["--sharded"])
+    _options["shard"] = None
+    if args["--shard"]:
+        _match = re.fullmatch(r"(\d+)/(\d+)", args["--shard"])
+        if not _match or int(_match.group(1)) >= int(_match.group(2)):
+            sys.exit("--shard must be <i>/<N> (0 <= i < N)")
+        _options["shard"] = (int(_match.group(1)), int(_match.group(2)))
+        if _options.get("outputCsv") and _options["outputCsv"] != "-":
+            _options["outputCsv"] = shard_path(_options["outputCsv"], _options["shard"])
+    _options["fromSnapshot"] = args["--from-snapshot"]
     _options["dry-run"] = bool(args["--dry-run"])
+    # all / enroll の snapshot は --dry-run の見積もり専用(実行には API が必要)
+    if _options["fromSnapshot"] and _exec_mode in ("default", "enroll") \
+            and not _options["dry-run"]:
+        sys.exit("--from-snapshot with all / enroll requires --dry-run")
     _options["debug"] = bool(args["--debug"])
     if _options["debug"]:
         print("  {0:<20}{1:<20}{2:<20}".format("key", "value", "type"))
@@ -130,7 +219,44 @@ def parse_options():
     return _exec_mode, _options
 
 
-def api_init():
+def read_course_file(_course_file):
+    """read_course_file(_course_file)
+    """
+    # csv format:
+    # course id (or class code)[, ...]
+    _courses = []
+    with open(_course_file, "r") as _f:
+        for line in _f:
+            if line == "\n":
+                continue
+            line = line.rstrip("\n").split(",")
+            if line[0][0] == "#":
+                continue
+            _courses.append(line[0].strip())
+    return _courses
+
+
+def read_unenroll_file(_unenroll_file):
+    """read_unenroll_file(_unenroll_file)
+    """
+    # csv format:
+    # user id (or user Email), course id (or class code)
+    _unenrollments = []
+    with open(_unenroll_file, "r") as _f:
+        for line in _f:
+            if line == "\n":
+                continue
+            line = line.rstrip("\n").split(",")
+            if line[0][0] == "#":
+                continue
+            if len(line) < 2:
+                print("{0} has no course id, skip".format(line[0]))
+                continue
+            _unenrollments.append((line[0].strip(), line[1].strip()))
+    return _unenrollments
+
+
+def api_init(_token_file="token.pickle"):
     """ Initialization of Classroom API for enroll teacher / student to each classroom
     """
     scopes = ["https://www.googleapis.com/auth/classroom.courses",
@@ -145,8 +271,8 @@ def api_init():
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists("token.pickle"):
-        with open("token.pickle", "rb") as token:
+    if os.path.exists(_token_file):
+        with open(_token_file, "rb") as token:
             creds = pickle.load(token)
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
@@ -157,7 +283,7 @@ def api_init():
                 "credentials.json", scopes)
             creds = flow.run_local_server(port=0)
         # Save the credentials for the next run
-        with open("token.pickle", "wb") as token:
+        with open(_token_file, "wb") as token:
             pickle.dump(creds, token)
     _service_classroom = build("classroom", "v1", credentials=creds)
     return creds, _service_classroom
@@ -169,11 +295,22 @@ def read_data():
     # set filename configured by the execute option
     _class_file = options["classFile"] if "classFile" in options else "classes.csv"
     _enroll_file = options["enrollFile"] if "enrollFile" in options else "enrollments.csv"
-    _course_id_file = options["courseIdFile"] if "courseIdFile" in options else "coursesID.csv"
+    _course_id_file = options.get("courseIdFile")
+    # serve: 同じファイル(パスと更新時刻)であれば前回読み込んだ内容をそのまま使う
+    _signature = (exec_mode, tuple(
+        (os.path.abspath(_file), os.path.getmtime(_file))
+        for _file in (_class_file, "users.csv", _enroll_file,
+                      _course_id_file or registry_file, registry_file + "-wal")
+        if os.path.exists(_file)))
+    if data_cache.get("signature") == _signature:
+        return
+    for _data in (course_table, user_emails, enroll_users):
+        _data.clear()
+    data_cache["signature"] = _signature
     # read classes.csv for opened classroom
     # csv format:
     # class_code(Key), subjectName, teacher id, className
-    if exec_mode == "create":
+    if exec_mode in ("create", "default"):
         with open(_class_file, "r") as _f:
             for line in _f:
                 if line == "\n":
@@ -181,17 +318,15 @@ def read_data():
                 line = line.rstrip("\n").split(",")
                 if line[0][0] == "#":
                     continue
-                try:  # Check duplicated line in classFile
-                    class_subjects[line[0]]
+                if course_table.get(line[0]):  # Check duplicated line in classFile
                     continue
-                except KeyError:  # first appear line is active
-                    class_subjects[line[0]] = line[1]
-                    class_teachers[line[0]] = line[2]
-                    class_sections[line[0]] = line[3]
+                # first appear line is active
+                course_table.add(line[0], subject=line[1], teacher_id=line[2],
+                                 section=line[3])
     # read users.csv, getting email address from user id
     # csv format:
     # user id, user Email
-    if exec_mode in ("enroll", "unenroll", "create"):
+    if exec_mode in ("enroll", "unenroll", "create", "default"):
         with open("users.csv", "r") as _f:
             for line in _f:
                 if line == "\n":
@@ -204,7 +339,7 @@ def read_data():
     # csv format:
     # class_code(Multiple Key), user id
     # if any(x in options for x in ("enroll", "unenroll", "create")):
-    if exec_mode in ("enroll", "unenroll", "create"):
+    if exec_mode in ("enroll", "unenroll", "create", "default"):
         with open(_enroll_file, "r") as _f:
             for line in _f:
                 if line == "\n":
@@ -214,33 +349,336 @@ def read_data():
                     continue
                 # multiple values for single key
                 enroll_users.setdefault(line[0], []).append(line[1])
-    # read already created course ID
-    # csv format:
-    # class_code, Google Classroom course id
-    if exec_mode != "create":
-        with open(_course_id_file, "r") as _f:
-            for line in _f:
-                if line == "\n":
-                    continue
-                line = line.rstrip("\n").split(",")
-                if line[0][0] == "#":
-                    continue
-                # classCode regex match?
-                if re.match(class_code_regex, line[0]):
-                    course_lists[line[0]] = line[1]
-                    course_names[line[0]] = line[2]
-                    course_owners[line[0]] = line[3]
-                    class_codes[line[1]] = line[0]  # reverse index
-                    if len(line) >= 6:
-                        # overwrite by courseIdFile
-                        class_sections[line[0]] = line[5]
-                        class_teachers[line[0]] = line[6]
-                    else:
-                        class_sections[line[0]] = None
-                        class_teachers[line[0]] = None
+    # read already created course ID from the course registry
+    # (<coursesFile> を指定した場合はその csv だけを一時 registry に読み込む)
+    # lists / user / snapshot 等の registry を使わないコマンドでは開かない(作成もしない)
+    if exec_mode in ("enroll", "default", "unenroll", "remove", "info", "archive",
+                     "active", "owner", "crawl", "getStream"):
+        conn = registry_open(":memory:" if _course_id_file else None)
+        if _course_id_file:
+            registry_import(conn, _course_id_file)
+        for _class_code, _course_id, _course_name, _owner, _section, _teacher in conn.execute(
+                "SELECT classCode, courseId, courseName, emailAddress, courseSection,"
+                " teacherNames FROM courses WHERE classCode IS NOT NULL ORDER BY rowid"):
+            # overwrite by courseIdFile
+            course_table.add(_class_code, course_id=_course_id, name=_course_name,
+                             owner=_owner, section=_section, teacher_names=_teacher)
+        conn.close()
     if options["debug"]:
-        print(course_lists)
-    return _course_id_file
+        print({record.class_code: record.course_id for record in course_table.created()})
+
+
+class Course:
+    """Course(class_code)
+    """
+    # コース 1 件分のレコード。__slots__ で属性辞書を持たず、5 万件規模でも小さく保つ。
+    #   subject / teacher_id: classes.csv、course_id / name / owner / teacher_names: registry
+    __slots__ = ("class_code", "course_id", "name", "owner", "section",
+                 "subject", "teacher_id", "teacher_names")
+
+    def __init__(self, class_code):
+        self.class_code = class_code
+        self.course_id = None
+        self.name = None
+        self.owner = None
+        self.section = None
+        self.subject = None
+        self.teacher_id = None
+        self.teacher_names = None
+
+
+class CourseTable:
+    """CourseTable()
+    """
+    # class code ごとに 1 レコードを持ち、courseId からも引ける索引を添える
+    # 同じ値が何度も現れる文字列(教員名、セクション等)は intern して共有する。
+
+    def __init__(self):
+        self.by_code = {}
+        self.by_id = {}
+
+    def clear(self):
+        """clear()
+        """
+        self.by_code.clear()
+        self.by_id.clear()
+
+    def get(self, class_code):
+        """get(class_code)
+        """
+        return self.by_code.get(class_code)
+
+    def add(self, class_code, **fields):
+        """add(class_code, **fields)
+        """
+        # 既存のレコードがあれば fields で上書きする
+        record = self.by_code.get(class_code)
+        if record is None:
+            class_code = sys.intern(class_code)
+            record = self.by_code[class_code] = Course(class_code)
+        for _field, _value in fields.items():
+            if isinstance(_value, str):
+                _value = sys.intern(_value)
+            setattr(record, _field, _value)
+            if _field == "course_id" and _value:
+                self.by_id[_value] = record  # reverse index
+        return record
+
+    def classes(self):
+        """classes()
+        """
+        # classes.csv に記載されたクラス(読み込み順)
+        return [record for record in self.by_code.values() if record.subject is not None]
+
+    def created(self):
+        """created()
+        """
+        # 作成済み(courseId のある)クラス(registry の登録順)
+        return [record for record in self.by_code.values() if record.course_id]
+
+    def course_id(self, _key):
+        """course_id(_key)
+        """
+        # class code なら courseId に、それ以外(courseId 等)はそのまま返す
+        record = self.by_code.get(_key)
+        return record.course_id if record and record.course_id else _key
+
+
+def registry_open(_registry_file=None):
+    """registry_open(_registry_file=None)
+    """
+    # coursesID.csv に代わるコース登録簿(SQLite)。classCode / courseId に索引を持ち、
+    # WAL と busy timeout により複数プロセスから同時に書き込める。
+    # 初回は既存の coursesID.csv を取り込む。
+    _registry_file = _registry_file or registry_file
+    _migrate = _registry_file != ":memory:" and not os.path.exists(_registry_file)
+    conn = sqlite3.connect(_registry_file, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS courses (
+            classCode TEXT, courseId TEXT PRIMARY KEY, courseName TEXT,
+            emailAddress TEXT, ownerId TEXT, courseSection TEXT,
+            teacherNames TEXT, enrollCode TEXT, status TEXT);
+        CREATE INDEX IF NOT EXISTS courses_class_code ON courses (classCode);
+    """)
+    if _migrate and os.path.exists("coursesID.csv"):
+        print("import coursesID.csv to {0}".format(_registry_file))
+        registry_import(conn, "coursesID.csv")
+    return conn
+
+
+def registry_add(conn, row):
+    """registry_add(conn, row)
+    """
+    # row: classCode, courseId, courseName, emailAddress, ownerId, courseSection,
+    #      teacherNames, enrollCode, status
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO courses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     row)
+
+
+def registry_import(conn, _csv_file):
+    """registry_import(conn, _csv_file)
+    """
+    # csv format (create):
+    # class_code, course id, courseName, owner Email, enrollCode
+    # csv format (lists):
+    # class_code, course id, courseName, owner Email, ownerId, section, teacherNames,
+    # enrollCode, status
+    # registry_export / lists は csv.writer で書くため、カンマを含む授業名は引用符付きになる
+    rows = []
+    with open(_csv_file, "r", newline="") as _f:
+        for line in csv.reader(_f):
+            if not line or not line[0]:
+                continue
+            if line[0][0] == "#":
+                continue
+            line = [_value if _value != "" else None for _value in line]
+            # classCode regex match?
+            if not re.match(class_code_regex, line[0]):
+                continue
+            if len(line) >= 6:
+                line += [None] * (9 - len(line))
+                rows.append(line[:9])
+            else:
+                line += [None] * (5 - len(line))
+                rows.append(line[:4] + [None, None, None, line[4], None])
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO courses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+
+def registry_export(conn, _csv_file):
+    """registry_export(conn, _csv_file)
+    """
+    with open(_csv_file, "w") as _f:
+        writer = csv.writer(_f, lineterminator="\n")
+        # csv indexes (same as lists)
+        writer.writerow(["#class_code", "courseId", "courseName", "emailAddress",
+                         "ownerId", "courseSection", "teacherNames", "enrollCode",
+                         "status"])
+        rows = conn.execute("SELECT * FROM courses ORDER BY rowid").fetchall()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def registry_command():
+    """registry_command()
+    """
+    conn = registry_open()
+    if options["registryAction"] == "import":
+        print("{0} courses imported".format(
+            registry_import(conn, options["csvFile"])))
+    else:
+        print("{0} courses exported".format(
+            registry_export(conn, options["csvFile"])))
+    conn.close()
+
+
+def enroll_delta(_previous_file):
+    """enroll_delta(_previous_file)
+    """
+    # 前回の enrollments.csv(または保存した state)との差分を (class_code, user id) の
+    # 集合演算で求め、enroll_users を追加分だけに置き換える。戻り値は削除分と変更のない分。
+    previous = set()
+    with open(_previous_file, "r") as _f:
+        for line in _f:
+            if line == "\n":
+                continue
+            line = line.rstrip("\n").split(",")
+            if line[0][0] == "#":
+                continue
+            previous.add((line[0], line[1]))
+    current = {(class_code, user_id) for class_code, user_ids in enroll_users.items()
+               for user_id in user_ids}
+    added = current - previous
+    dropped = sorted(previous - current)
+    print("enrollments since {0}: {1} added, {2} dropped, {3} unchanged".format(
+        _previous_file, len(added), len(dropped), len(current & previous)))
+    enroll_users.clear()
+    for class_code, user_id in sorted(added):
+        enroll_users.setdefault(class_code, []).append(user_id)
+    # enroll_users を書き換えたため serve の読み込みキャッシュを無効にする
+    data_cache.clear()
+    return dropped, current & previous
+
+
+def save_enroll_state(applied):
+    """save_enroll_state(applied)
+    """
+    # enrollments.csv のうち登録できた(または登録済みだった)組だけを state に残す。
+    # 失敗した組や未作成のクラスの組は次回の --since で追加分として再試行される。
+    # --shard: shard ごとの state に保存する(merge で結合できる)
+    _state_file = shard_path(enroll_state_file, options["shard"]) \
+        if options["shard"] else enroll_state_file
+    with open(options["enrollFile"], "r") as _f, open(_state_file, "w") as _out:
+        for line in _f:
+            _fields = line.rstrip("\n").split(",")
+            if line == "\n" or line[0] == "#" or (
+                    tuple(_fields[:2]) in applied
+                    and in_shard(course_table.course_id(_fields[0]))):
+                _out.write(line)
+
+
+def plan_job(dropped=()):
+    """plan_job(dropped=())
+    """
+    # --dry-run: API を呼ばずに endpoint ごとの呼び出し数、course registry / snapshot から
+    # 見て実施済みの件数、招待の quota 日数、レート制限・並列数での所要時間を見積もる
+    plan = {}  # endpoint: [calls, satisfied]
+
+    def count(_endpoint, _satisfied=False):
+        plan.setdefault(_endpoint, [0, 0])
+        plan[_endpoint][0] += 1
+        if _satisfied:
+            plan[_endpoint][1] += 1
+
+    if exec_mode in ("create", "default"):
+        conn = registry_open()
+        created = {_class_code for (_class_code,) in conn.execute(
+            "SELECT classCode FROM courses")}
+        conn.close()
+        for record in course_table.classes():
+            count("courses.create", record.class_code in created)
+    members = {}
+    if exec_mode in ("enroll", "default"):
+        if options["fromSnapshot"]:
+            conn = snapshot_connect()
+            for _course_id, _member in conn.execute(
+                    "SELECT courseId, lower(emailAddress) FROM students"
+                    " UNION ALL SELECT courseId, lower(emailAddress) FROM teachers"
+                    " UNION ALL SELECT courseId, lower(userId) FROM invitations"):
+                members.setdefault(_course_id, set()).add(_member)
+            conn.close()
+        targets = course_table.classes() if exec_mode == "default" else course_table.created()
+        # dry-run では API を初期化しないため、実行時と同じ shard の割り当てをここで作る
+        ring = HashRing(range(len(token_files)))
+        if options["foreignDomain"]:
+            _endpoint = "invitations.create"
+        elif options["teacherRole"]:
+            _endpoint = "courses.teachers.create"
+        else:
+            _endpoint = "courses.students.create"
+        for record in targets:
+            class_code = record.class_code
+            if class_code not in enroll_users:
+                continue
+            _members = members.get(record.course_id, set())
+            class_teacher = record.owner or user_emails.get(record.teacher_id)
+            if options["foreignDomain"]:
+                # add_admin_users: shard 0 の adminUser 所有のコースは対象外、それ以外は
+                # 教員一覧(list 1 ページ)で確認してから追加し、最後に外す
+                _shard = ring.get(record.course_id) if record.course_id else 0
+                if class_teacher in (adminUser, admin_id) and _shard == 0:
+                    count("courses.teachers.create (admin)", True)
+                else:
+                    count("courses.teachers.list (admin pages)")
+                    _satisfied = adminUser.lower() in _members
+                    count("courses.teachers.create (admin)", _satisfied)
+                    if not _satisfied:
+                        count("courses.teachers.delete (admin)")
+            for user_id in enroll_users[class_code]:
+                _email = user_emails.get(user_id, user_id)
+                count(_endpoint, _email.lower() in _members)
+        if options["foreignDomain"]:
+            # get_admin_ids: adminUser 以外の管理者アカウントの profile
+            for _ in token_files[1:]:
+                count("userProfiles.get (admin)")
+    if dropped and options.get("withDrop"):
+        # delete_user: コースごとに学生・教員の名簿(list 1 ページ以上)を取得してから削除
+        for _ in {class_code for class_code, _ in dropped}:
+            count("courses.students.list (roster pages)")
+            count("courses.teachers.list (roster pages)")
+        for _ in dropped:
+            count("courses.students/teachers.delete")
+    # 実行時に送らない(登録済みのクラス、既に教員の adminUser)分は合計と所要時間から除く
+    _skipped = ("courses.create", "courses.teachers.create (admin)")
+    _total = sum(_calls - (_satisfied if _endpoint in _skipped else 0)
+                 for _endpoint, (_calls, _satisfied) in plan.items())
+    _shards = len(token_files)
+    print("dry-run plan ({})".format(exec_mode))
+    print("  {0:<36}{1:>10}{2:>12}".format("endpoint", "calls", "satisfied"))
+    print("  {0:-<58}".format(""))
+    for _endpoint, (_calls, _satisfied) in plan.items():
+        print("  {0:<36}{1:>10}{2:>12}".format(_endpoint, _calls, _satisfied))
+    print("  {0:-<58}".format(""))
+    print("  {0:<36}{1:>10}{2:>12}".format(
+        "total (to send)", _total, sum(_satisfied for _, _satisfied in plan.values())))
+    if "invitations.create" in plan:
+        _invites = plan["invitations.create"][0] - plan["invitations.create"][1]
+        print("  invitation quota : {0} day(s) ({1} invitations / day)".format(
+            -(-_invites // invitation_quota), invitation_quota))
+    # 実効スループットは レート制限 と 並列数 / 1 query の latency の小さい方
+    _throughput = min(query_per_sec * _shards,
+                      max_concurrency * _shards / query_latency)
+    print("  concurrency      : {0} process x {1} shard(s)".format(
+        max_concurrency, _shards))
+    print("  rate limit       : {0} query / sec x {1} shard(s)".format(
+        query_per_sec, _shards))
+    _seconds = int(_total / _throughput)
+    print("  projected time   : {0}:{1:02}:{2:02} ({3:.1f} query / sec)".format(
+        _seconds // 3600, _seconds % 3600 // 60, _seconds % 60, _throughput))
 
 
 def create_classroom(_class_subject, _class_section, _class_teacher):
@@ -270,132 +708,221 @@ def create_classroom(_class_subject, _class_section, _class_teacher):
     return _course_id, _enroll_code
 
 
-def add_admin_user(_course_id):
-    """add_admin_user(_course_id)
+def add_admin_users(_course_ids):
+    """add_admin_users(_course_ids)
     """
-    _course_id = get_course_id(_course_id)
-    # この関数はメインプロセスから直接呼ばれるため、グローバルの service 辞書を使用する。
-    # worker 関数（invite_users_proc 等）はサブプロセスで実行されるためローカル _service を使うが、
-    # add_admin_user / delete_admin_user はその対象外。
-    if _course_id not in service:
-        service[_course_id] = build(
-            "classroom", "v1", credentials=creds_classroom)
-    teacher = {"userId": "me"}
-    try:
-        teacher = (
-            service[_course_id].courses()
-            .teachers()
-            .create(courseId=_course_id, body=teacher)
-            .execute()
-        )
-        if options["debug"]:
-            print("Course {0} add Admin User".format(_course_id))
-    except HttpError as _e:
-        error = json.loads(_e.content).get("error")
-        if error.get("code") == 409:  # 409 is already exists
+    # 対象コースの教員一覧をまとめて取得し、管理者がまだ教員でないコースにだけ
+    # 管理者("me")を教員としてバッチで追加する。
+    # 戻り値は実際に追加したコース(delete_admin_users で外す対象)。
+    _course_ids = list(dict.fromkeys(_course_ids))
+    calls = [("courses.teachers", "list",
+              {"courseId": _course_id,
+               "fields": "teachers(userId,profile/emailAddress)"})
+             for _course_id in _course_ids]
+    targets = []
+    for _course_id, (results, _code) in zip(
+            _course_ids, batch_execute(calls, key=course_key)):
+        if _code == 404:  # 404 is NOT_FOUND
+            print("course {0} is not found".format(_course_id))
+            continue
+        members = set()
+        for teacher in (results or {}).get("teachers", []):
+            members.add(teacher.get("userId"))
+            members.add(teacher.get("profile", {}).get("emailAddress", "").lower())
+        if members & get_admin_ids(get_shard(_course_id)):
             if options["debug"]:
-                print("Already added Admin User")
-        elif error.get("code") == 500:  # internal error
-            print("Internal error encountered")
+                print("Already added Admin User {0}".format(_course_id))
+            continue
+        targets.append(_course_id)
+    calls = [("courses.teachers", "create",
+              {"courseId": _course_id, "body": {"userId": "me"}})
+             for _course_id in targets]
+    added = []
+    for _course_id, (_, _code) in zip(
+            targets, batch_execute(calls, key=course_key)):
+        if _code is None:
+            added.append(_course_id)
+            if options["debug"]:
+                print("Course {0} add Admin User".format(_course_id))
+        elif _code == 409:  # 409 is already exists
+            if options["debug"]:
+                print("Already added Admin User {0}".format(_course_id))
         else:
-            raise
+            print("Course {0} add Admin User error({1})".format(_course_id, _code))
+    return added
 
 
-def delete_admin_user(_course_id):
-    """delete_admin_user(_course_id)
+def delete_admin_users(_course_ids):
+    """delete_admin_users(_course_ids)
     """
-    _course_id = get_course_id(_course_id)
-    if _course_id not in service:
-        service[_course_id] = build(
-            "classroom", "v1", credentials=creds_classroom)
-    try:
-        service[_course_id].courses().teachers().delete(
-            courseId=_course_id, userId="me"
-        ).execute()
-        if options["debug"]:
-            print("Course {0} delete Admin User".format(_course_id))
-    except HttpError as _e:
-        error = json.loads(_e.content).get("error")
-        if error.get("code") == 404:  # 404 is NOT_FOUND
+    calls = [("courses.teachers", "delete",
+              {"courseId": _course_id, "userId": "me"})
+             for _course_id in _course_ids]
+    for _course_id, (_, _code) in zip(
+            _course_ids, batch_execute(calls, key=course_key)):
+        if _code is None:
+            if options["debug"]:
+                print("Course {0} delete Admin User".format(_course_id))
+        elif _code == 404:  # 404 is NOT_FOUND
             if options["debug"]:
-                print(
-                    "Course Admin Teacher {0} is not found".format(_course_id))
+                print("Course Admin Teacher {0} is not found".format(_course_id))
         else:
-            raise
+            print("Course {0} delete Admin User error({1})".format(
+                _course_id, _code))
 
 
-def delete_user(_course_ids, _user_id):
-    """delete_user(_course_id, _user_id)
+def get_admin_ids(_shard):
+    """get_admin_ids(_shard)
     """
-    if '@' not in _user_id:
-        _user_id = user_emails[_user_id]
-    for _course_id in _course_ids:
-        _course_id = get_course_id(_course_id)
-        if options["dry-run"]:
+    # shard(管理者アカウント)の userId / emailAddress
+    if _shard not in admin_ids:
+        if _shard == 0:
+            admin_ids[_shard] = {admin_id, adminUser.lower()}
+        else:
+            _user_info = build("classroom", "v1", credentials=shard_creds[_shard]) \
+                .userProfiles().get(userId="me").execute()
+            admin_ids[_shard] = {_user_info.get("id"),
+                                 _user_info.get("emailAddress", "").lower()}
+    return admin_ids[_shard]
+
+
+def course_key(call):
+    """course_key(call)
+    """
+    return call[2]["courseId"]
+
+
+def delete_user(_unenrollments):
+    """delete_user(_unenrollments)
+    """
+    # _unenrollments: (user id or Email, course id or class code) のリスト
+    pairs = []
+    for _user_id, _course_id in _unenrollments:
+        if '@' not in _user_id:
+            if _user_id not in user_emails:
+                print("{0} is not found in users file, skip unenroll from {1}".format(
+                    _user_id, _course_id))
+                continue
+            _user_id = user_emails[_user_id]
+        pairs.append((_user_id, get_course_id(_course_id)))
+    if options["dry-run"]:
+        for _user_id, _course_id in pairs:
             print("user {0} remove from course {1}".format(
                 _user_id, _course_id))
+        return
+    # students().delete -> 404 -> teachers().delete と手探りで削除するのをやめ、
+    # コースごとに一度だけ取得した名簿(course_rosters)でロールを判定してから削除する。
+    get_rosters([_course_id for _, _course_id in pairs])
+    calls = []
+    targets = []
+    for _user_id, _course_id in pairs:
+        _students, _teachers = course_rosters.get(_course_id, (set(), set()))
+        if _user_id.lower() in _students:
+            calls.append(("courses.students", "delete",
+                          {"courseId": _course_id, "userId": _user_id}))
+            targets.append((_user_id, _course_id, "student"))
+        elif _user_id.lower() in _teachers:
+            calls.append(("courses.teachers", "delete",
+                          {"courseId": _course_id, "userId": _user_id}))
+            targets.append((_user_id, _course_id, "teacher"))
         else:
+            print("{0} is not found as student / teacher roll in course {1}".format(
+                _user_id, _course_id))
+    for (_user_id, _course_id, _role), (_, _code) in zip(
+            targets, batch_execute(calls)):
+        if _code is None:
+            print("unenroll {0} from course id {1}: success removed from {2} roll".format(
+                _user_id, _course_id, _role))
+        elif _code == 404:  # 404 is NOT_FOUND
+            print("{0} is not found as {1} roll in course {2}".format(
+                _user_id, _role, _course_id))
+        else:
+            print("unenroll {0} from course id {1}: error({2})".format(
+                _user_id, _course_id, _code))
+
+
+def get_rosters(_course_ids):
+    """get_rosters(_course_ids)
+    """
+    _course_ids = [_course_id for _course_id in dict.fromkeys(_course_ids)
+                   if _course_id not in course_rosters]
+    for index, result in tqdm(
+            run_parallel(roster_proc, [(_course_id,) for _course_id in _course_ids],
+                         # students().list + teachers().list (1 ページ以上)
+                         cost=lambda task: 2),
+            total=len(_course_ids)):
+        course_rosters[_course_ids[index]] = result
+    return course_rosters
+
+
+def roster_proc(_course_id, creds_classroom):
+    """roster_proc(_course_id, creds_classroom)
+    """
+    # 学生・教員それぞれの userId と emailAddress(小文字)の集合を返す
+    _service = get_service(creds_classroom)
+    rosters = []
+    for _resource, _key in ((_service.courses().students(), "students"),
+                            (_service.courses().teachers(), "teachers")):
+        members = set()
+        page_token = None
+        while True:
             try:
-                print('unenroll {0} from course id {1}'.format(
-                    _user_id, _course_id))
-                service_classroom.courses().students().delete(
-                    courseId=_course_id, userId=_user_id).execute()
-                print("success removed from student roll")
+                results = _resource.list(
+                    pageSize=0, courseId=_course_id, pageToken=page_token,
+                    fields="nextPageToken,{0}(userId,profile/emailAddress)".format(_key)
+                ).execute()
             except HttpError as _e:
                 error = json.loads(_e.content).get("error")
-                if error.get("code") == 404:  # 404 is NOT_FOUND
-                    # if options["debug"]:
-                    print("{0} is not found as student roll in course {1}".format(
-                        _user_id, _course_id))
-                    try:
-                        service_classroom.courses().teachers().delete(
-                            courseId=_course_id, userId=_user_id).execute()
-                        print("success removed from teacher roll")
-                    except HttpError as _e:
-                        error = json.loads(_e.content).get("error")
-                        if error.get("code") == 404:  # 404 is NOT_FOUND
-                            print("{0} is not found as teacher roll in course {1}".format(
-                                _user_id, _course_id))
+                if error.get("code") == 404:  # 404 is not found
+                    print("Course Not Found {0}".format(_course_id))
+                    break
                 else:
                     raise
+            for member in results.get(_key, []):
+                members.add(member.get("userId"))
+                _email = member.get("profile", {}).get("emailAddress")
+                if _email:
+                    members.add(_email.lower())
+            page_token = results.get('nextPageToken', None)
+            if not page_token:
+                break
+        rosters.append(members)
+    return tuple(rosters)
 
 
 def update_courses(_course_ids, _owner=None):
-    """update_courses(_course_ids)
+    """update_courses(_course_ids, _owner=None)
     """
+    # courses().get + 全項目の courses().update をやめ、変更する項目だけを
+    # updateMask 付きの courses().patch で送る(事前の get は不要)。
     _course_state = "ARCHIVED" if exec_mode == "archive" else "ACTIVE"
-    for _course_id in _course_ids:
-        _course_id = get_course_id(_course_id)
-        _course_info = service_classroom.courses().get(id=_course_id).execute()
-        _course_owner = _owner if _owner is not None else _course_info.get(
-            "ownerId")
-        body = {
-            "id": _course_id,
-            "courseState": _course_state,
-            "name": _course_info.get("name"),
-            "section": _course_info.get("section"),
-            "description": _course_info.get("description"),
-            "room": _course_info.get("room"),
-            "ownerId": _course_owner
-        }
-        if options["dry-run"]:
+    body = {"courseState": _course_state}
+    if _owner is not None:
+        body["ownerId"] = _owner
+    update_mask = ",".join(body.keys())
+    _course_ids = [get_course_id(_course_id) for _course_id in _course_ids]
+    if options["dry-run"]:
+        for _course_id in _course_ids:
             print("course {0} is changed {1}({2})".format(
-                _course_id, _course_state, _course_owner))
+                _course_id, _course_state, _owner))
+        return
+    print('trying change state to {0} for {1} courses...'.format(
+        _course_state, len(_course_ids)))
+    calls = [("courses", "patch",
+              {"id": _course_id, "updateMask": update_mask, "body": body})
+             for _course_id in _course_ids]
+    changed = 0
+    for _course_id, (_course_info, _code) in zip(_course_ids, batch_execute(calls)):
+        if _course_info:
+            changed += 1
+            print("course {0}: {1}({2}) done".format(
+                _course_id, _course_info.get("courseState"),
+                _course_info.get("ownerId")))
+        elif _code == 404:  # 404 is NOT_FOUND
+            print("course {0} is not found".format(_course_id))
         else:
-            try:
-                print('trying change state to {0} for course {1}({2})...'.format(
-                    _course_state, _course_id, _course_owner))
-                service_classroom.courses().update(
-                    id=_course_id, body=body).execute()
-                print('done')
-            except HttpError as _e:
-                error = json.loads(_e.content).get("error")
-                if error.get("code") == 404:  # 404 is NOT_FOUND
-                    if options["debug"]:
-                        print(
-                            "course {} is not found".format(_course_id))
-                else:
-                    raise
+            print("course {0} error({1})".format(_course_id, _code))
+    print("{0}/{1} courses changed".format(changed, len(_course_ids)))
 
 
 def invite_users(class_id):
@@ -403,7 +930,8 @@ def invite_users(class_id):
     """
     _role = 'TEACHER' if options["teacherRole"] else 'STUDENT'
     users = []
-    for user_id in enroll_users[class_id]:
+    user_ids = enroll_users[class_id]
+    for user_id in user_ids:
         # Possibly not work properly(2021.04 add sira)
         _course_id = get_course_id(class_id)
         _invite_user = user_emails[user_id]
@@ -415,13 +943,20 @@ def invite_users(class_id):
         users.append(user)
         if options["debug"]:
             print([_course_id, user])
-    results = []
-    worker = partial(invite_users_proc, options=options, creds_classroom=creds_classroom)
-    with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-        for result in tqdm(executor.map(worker, users), total=len(users)):
-            results.append(result)
+    results = [None] * len(users)
+    applied = []
+    worker = partial(invite_users_proc, options=options)
+    for index, (result, _applied) in tqdm(
+            run_parallel(worker, [(user,) for user in users],
+                         key=lambda task: task[0]["courseId"]),
+            total=len(users)):
+        results[index] = result
+        if _applied:
+            applied.append(user_ids[index])
     for result in results:
         print(result)
+    # 招待できた(または招待・登録済みの)利用者を返す(enroll state)
+    return applied
 
 
 def invite_users_proc(user, options, creds_classroom):
@@ -432,8 +967,9 @@ def invite_users_proc(user, options, creds_classroom):
     if options["debug"]:
         print([_course_id, user_id])
     if not options["dry-run"]:
-        _service = build("classroom", "v1", credentials=creds_classroom)
+        _service = get_service(creds_classroom)
         result = 'user={}'.format(user_id)
+        _applied = True
         try:
             user = _service.invitations().create(body=user).execute()
             result += " invite to {}.".format(_course_id)
@@ -445,13 +981,17 @@ def invite_users_proc(user, options, creds_classroom):
                 result += " is already member of ({}).".format(_course_id)
             elif error.get("code") == 401:
                 print("Authentication error")
+                _applied = False
             elif error.get("code") == 403:
                 print("Permission Denied in {}".format(_course_id))
+                _applied = False
             elif error.get("code") == 404:
                 print("course {0} is not found".format(_course_id))
+                _applied = False
             else:
                 raise
-        return result
+        return result, _applied
+    return None, False
 
 
 def create_users(class_id):
@@ -459,7 +999,8 @@ def create_users(class_id):
     """
     course_ids = []
     users = []
-    for user_id in enroll_users[class_id]:
+    user_ids = enroll_users[class_id]
+    for user_id in user_ids:
         # Possibly not work properly(2021.04 add sira)
         _course_id = get_course_id(class_id)
         _enroll_user = user_emails[user_id]
@@ -472,18 +1013,22 @@ def create_users(class_id):
         users.append(user)
         if options["debug"]:
             print([_course_id, user])
+    applied = []
     if not options["dry-run"]:
-        worker = partial(create_users_proc, options=options, creds_classroom=creds_classroom)
-        with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-            for _ in tqdm(executor.map(worker, course_ids, users),
-                          total=len(course_ids)):
-                pass
+        worker = partial(create_users_proc, options=options)
+        for index, _applied in tqdm(run_parallel(worker, list(zip(course_ids, users)),
+                                                 key=lambda task: task[0]),
+                                    total=len(course_ids)):
+            if _applied:
+                applied.append(user_ids[index])
+    # 登録できた(または登録済みの)利用者を返す(enroll state)
+    return applied
 
 
 def create_users_proc(_course_id, user, options, creds_classroom):
     """create_users_proc(_course_id, user, options, creds_classroom)
     """
-    _service = build("classroom", "v1", credentials=creds_classroom)
+    _service = get_service(creds_classroom)
     try:
         if options["teacherRole"]:
             user = (
@@ -520,90 +1065,186 @@ def create_users_proc(_course_id, user, options, creds_classroom):
             )
         elif error.get("code") == 403:
             print("...Permission Denied.")
+            return False
         elif error.get("code") == 404:
             print("course {0} is not found".format(_course_id))
+            return False
         else:
             print(error.get("code"))
             raise
+    return True
 
 
-def delete_classroom(_course_id):
-    """delete_classroom(_course_id)
+def delete_classroom(_course_ids):
+    """delete_classroom(_course_ids)
     """
-    try:
-        service_classroom.courses().delete(id=_course_id).execute()
-        print("Course {0} has been removed".format(_course_id))
-    except HttpError as _e:
-        error = json.loads(_e.content).get("error")
-        if error.get("code") == 404:  # 404 is NOT_FOUND
+    _course_ids = [get_course_id(_course_id) for _course_id in _course_ids]
+    if options["dry-run"]:
+        for _course_id in _course_ids:
+            print("course {0} is removed".format(_course_id))
+        return
+    print("removing.. {} courses".format(len(_course_ids)))
+    calls = [("courses", "delete", {"id": _course_id})
+             for _course_id in _course_ids]
+    removed = []
+    for _course_id, (_, _code) in zip(_course_ids, batch_execute(calls)):
+        if _code is None:
+            print("Course {0} has been removed".format(_course_id))
+            removed.append((_course_id,))
+        elif _code == 404:  # 404 is NOT_FOUND
             print("Course ID {0} has already been deleted".format(_course_id))
+            removed.append((_course_id,))
         else:
-            raise
+            print("Course {0} error({1})".format(_course_id, _code))
+    # 削除したコースを course registry からも除く(create / all で作り直せるように)
+    conn = registry_open()
+    with conn:
+        conn.executemany("DELETE FROM courses WHERE courseId = ?", removed)
+    conn.close()
 
 
 def list_classroom():
     """list_classroom()
     """
-    page_token = None
-    courses = []
     if options["listAllStates"]:
         course_states = None
     else:
         course_states = "ACTIVE"
+    with open(options["outputCsv"], "w") as _f:
+        writer = csv.writer(_f, lineterminator="\n")
+        # csv indexes
+        writer.writerow(
+            [
+                "class_code",
+                "courseId",
+                "courseName",
+                "emailAddress",
+                "ownerId",
+                "courseSection",
+                "teacherNames",
+                "enrollCode",
+                "status",
+            ]
+        )
+        if options["fromSnapshot"]:
+            # write csv file.
+            writer.writerows([result for result in list_classroom_snapshot(
+                course_states) if result])
+            return
+        # courses().list のページを受け取った順にそのまま worker へ流し込み、
+        # ページングと各コースの詳細取得を重ねる(全ページをメモリに溜めない)。
+        # 完了順に返る結果は一覧の順序に並べ直して逐次書き出す。
+        worker = partial(list_classroom_proc,
+                         options=options,
+                         class_code_regex=class_code_regex)
+        buffer = {}
+        _total_courses = 0
+        for index, result in tqdm(
+                run_parallel(worker, ((course,) for course in list_courses(
+                    course_states, teacher_ids=options["teacherIds"])),
+                             # teachers().list + userProfiles().get
+                             cost=lambda task: 2,
+                             key=lambda task: task[0].get("id"))):
+            buffer[index] = result
+            while _total_courses in buffer:
+                result = buffer.pop(_total_courses)
+                _total_courses += 1
+                if result:
+                    # write csv file.
+                    writer.writerow(result)
+    if not _total_courses:
+        print("No courses found")
+    else:
+        print("total Courses: {} ".format(_total_courses))
+
+
+def list_courses(course_states, fields=None, teacher_ids=None):
+    """list_courses(course_states, fields=None, teacher_ids=None)
+    """
+    # generator: 1 ページ(最大 500 件)取得するごとに各コースを返す
+    # courseStates(指定がなければ全状態)ごと、teacher_ids があれば教員ごとに
+    # 独立したページ列に分割し、各分割をスレッドで同時にページングする。
+    # 一覧にかかる時間は全件ではなく最大の分割で決まる。
+    # 複数の教員がいるコースは重複して返るため courseId で除く。
+    partitions = [(_state, _teacher_id)
+                  for _state in ([course_states] if course_states else COURSE_STATES)
+                  for _teacher_id in (teacher_ids or [None])]
+    if len(partitions) == 1:
+        yield from list_course_pages(service_classroom, *partitions[0], fields=fields)
+        return
+    # 消費(run_parallel)が遅い場合に全件をメモリに溜めないよう、数ページ分で待たせる。
+    # generator が途中で閉じられたら stop で各スレッドを打ち切る。
+    pages = queue.Queue(maxsize=LIST_QUEUE_PAGES * 500)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def page_partition(_state, _teacher_id):
+        try:
+            for course in list_course_pages(get_service(shard_creds[0]), _state,
+                                            _teacher_id, fields=fields,
+                                            limiter=shard_limiters[0]):
+                if not put(course):
+                    return
+        except Exception as _e:
+            put(_e)
+        finally:
+            put(None)
+
+    seen = set()
+    _executor = ThreadPoolExecutor(max_workers=min(len(partitions), max_concurrency))
+    try:
+        for _partition in partitions:
+            _executor.submit(page_partition, *_partition)
+        running = len(partitions)
+        while running:
+            course = pages.get()
+            if course is None:
+                running -= 1
+            elif isinstance(course, Exception):
+                raise course
+            elif course.get("id") not in seen:
+                seen.add(course.get("id"))
+                yield course
+    finally:
+        stop.set()
+        _executor.shutdown(wait=False, cancel_futures=True)
+
+
+def list_course_pages(_service, course_states, teacher_id, fields=None, limiter=None):
+    """list_course_pages(_service, course_states, teacher_id, fields=None, limiter=None)
+    """
+    page_token = None
     while True:
-        results = service_classroom.courses().list(pageSize=0, pageToken=page_token,
-                                                   courseStates=course_states).execute()
+        if limiter:
+            limiter.acquire()
+        results = _service.courses().list(pageSize=0, pageToken=page_token,
+                                          courseStates=course_states,
+                                          teacherId=teacher_id,
+                                          fields=fields).execute()
         # if set pageSize=0, 500 responses are max queue( at 2020.05.06 )
         page_token = results.get('nextPageToken', None)
         # if _course['id'] != "105250506097979753968":
-        courses += results.get("courses", [])
+        for course in results.get("courses", []):
+            yield course
         if not page_token:
             break
-    if not courses:
-        print("No courses found")
-    else:
-        _total_courses = len(courses)
-        print("total Courses: {} ".format(_total_courses))
-        with open(options["outputCsv"], "w") as _f:
-            writer = csv.writer(_f, lineterminator="\n")
-            # csv indexes
-            writer.writerow(
-                [
-                    "class_code",
-                    "courseId",
-                    "courseName",
-                    "emailAddress",
-                    "ownerId",
-                    "courseSection",
-                    "teacherNames",
-                    "enrollCode",
-                    "status",
-                ]
-            )
-            # initialize CSV results
-            results = []
-            worker = partial(list_classroom_proc,
-                             options=options,
-                             creds_classroom=creds_classroom,
-                             class_code_regex=class_code_regex)
-            with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-                for result in tqdm(
-                        executor.map(worker, courses), total=_total_courses):
-                    if result:
-                        results.append(result)
-            # write csv file.
-            writer.writerows(results)
 
 
 def list_classroom_proc(course, options, creds_classroom, class_code_regex):
     """list_classroom_proc(course, options, creds_classroom, class_code_regex)
     """
     _course_id = course.get("id")   # notice changed..
-    _service = build("classroom", "v1", credentials=creds_classroom)
+    _service = get_service(creds_classroom)
     results = _service.courses().teachers().list(
         courseId=_course_id).execute()
-    # '.*?([0-9]{5}[A-Z][0-9]{4})'
-    _class_code = re.match(class_code_regex, course.get("name"))
     _owner_id = course.get("ownerId")
     try:
         _teacher_info = _service.userProfiles().get(
@@ -621,9 +1262,8 @@ def list_classroom_proc(course, options, creds_classroom, class_code_regex):
     _teacher_names = ""
     for teacher in teachers:
         _teacher_names += "/" + str(teacher["profile"]["name"]["fullName"])
-    if _class_code:
-        return [
-            _class_code.group(1),
+    return list_row(
+        [
             course.get("id"),
             course.get("name"),
             _teacher_info.get("emailAddress"),
@@ -632,60 +1272,142 @@ def list_classroom_proc(course, options, creds_classroom, class_code_regex):
             _teacher_names.lstrip("/"),
             course.get("enrollmentCode"),
             course.get("courseState"),
-        ]
+        ],
+        options, class_code_regex)
+
+
+def list_row(row, options, class_code_regex):
+    """list_row(row, options, class_code_regex)
+    """
+    # row: courseId, courseName, emailAddress, ownerId, courseSection,
+    #      teacherNames, enrollCode, status
+    # '.*?([0-9]{5}[A-Z][0-9]{4})'
+    _class_code = re.match(class_code_regex, row[1])
+    if _class_code:
+        return [_class_code.group(1)] + list(row)
     elif options["listAllCourses"]:
-        return [
-            None,
-            course.get("id"),
-            course.get("name"),
-            _teacher_info.get("emailAddress"),
-            course.get("ownerId"),
-            course.get("section"),
-            _teacher_names.lstrip("/"),
-            course.get("enrollmentCode"),
-            course.get("courseState"),
-        ]
+        return [None] + list(row)
     else:
         return False
 
 
+def list_classroom_snapshot(course_states):
+    """list_classroom_snapshot(course_states)
+    """
+    conn = snapshot_connect()
+    results = []
+    for row in conn.execute(
+            "SELECT c.id, c.name, p.emailAddress, c.ownerId, c.section,"
+            " (SELECT group_concat(t.fullName, '/') FROM teachers t"
+            "  WHERE t.courseId = c.id),"
+            " c.enrollmentCode, c.courseState"
+            " FROM courses c LEFT JOIN profiles p ON p.userId = c.ownerId"
+            " WHERE ? IS NULL OR c.courseState = ?",
+            (course_states, course_states)):
+        results.append(list_row(list(row), options, class_code_regex))
+    conn.close()
+    print("total Courses: {} ".format(len(results)))
+    return results
+
+
 def info_classroom(_course_ids):
     """info_classroom(_course_ids)
     """
+    _course_ids = [get_course_id(_course_id) for _course_id in _course_ids]
+    if options["fromSnapshot"]:
+        info_classroom_snapshot(_course_ids)
+        return
+    # courses().get と teachers().list を全コース分まとめてバッチで並列取得し、
+    # owner の userProfiles().get は重複を除いてから取得する。出力は引数の順序を維持。
+    calls = []
     for _course_id in _course_ids:
-        _course_id = get_course_id(_course_id)
-        _course_info = service_classroom.courses().get(id=_course_id).execute()
-        print("course_id: {}".format(_course_info.get("id")))
-        print("name    : {}".format(_course_info.get("name")))
-        print("section : {}".format(_course_info.get("section")))
-        print("status  : {}".format(_course_info.get("courseState")))
+        calls.append(("courses", "get", {"id": _course_id}))
+        calls.append(("courses.teachers", "list", {"courseId": _course_id}))
+    results = batch_execute(calls)
+    course_infos = results[0::2]
+    teacher_lists = results[1::2]
+    get_profiles([_course_info.get("ownerId")
+                  for _course_info, _ in course_infos if _course_info])
+    for _course_id, (_course_info, _code), (_teachers, _) in zip(
+            _course_ids, course_infos, teacher_lists):
+        if not _course_info:
+            if _code == 404:  # 404 is NOT_FOUND
+                print("course {0} is not found".format(_course_id))
+            else:
+                print("course {0} error({1})".format(_course_id, _code))
+            continue
         _owner_id = _course_info.get("ownerId")
-        print("ownerId  : {}".format(_owner_id))
-        _teacher_info = service_classroom.userProfiles().get(userId=_owner_id).execute()
-        print("owner : {}({})".format(_teacher_info.get(
-            "emailAddress"), _teacher_info.get("name").get("fullName")))
-        results = service_classroom.courses().teachers().list(
-            courseId=_course_id).execute()
-        teachers = results.get("teachers", [])
+        teachers = (_teachers or {}).get("teachers", [])
         _teacher_names = ""
         for teacher in teachers:
             _teacher_names += "/" + str(teacher["profile"]["name"]["fullName"])
-        print("teacher : {}".format(_teacher_names))
+        print_course_info(_course_info, user_profiles.get(_owner_id) or {},
+                          _teacher_names)
         if options["detail"]:
-            if _owner_id != admin_id:
-                add_admin_user(_course_id)
+            added = add_admin_users([_course_id]) if _owner_id != admin_id else []
             print("Enrolled user lists...")
-            results = enrolled_students(_course_id)
-            if results:
-                for result in sorted(results):
-                    print("{},{}".format(result[0], result[1]))
+            print_users(enrolled_students(_course_id))
             print("Inviting user lists...")
-            results = invited_students(_course_id)
-            if results:
-                for result in sorted(results):
-                    print("{},{}".format(result[0], result[1]))
-            if _owner_id != admin_id:
-                delete_admin_user(_course_id)
+            print_users(invited_students(_course_id))
+            delete_admin_users(added)
+
+
+def info_classroom_snapshot(_course_ids):
+    """info_classroom_snapshot(_course_ids)
+    """
+    conn = snapshot_connect()
+    for _course_id in _course_ids:
+        row = conn.execute(
+            "SELECT c.id, c.name, c.section, c.courseState, c.ownerId,"
+            " p.emailAddress, p.fullName"
+            " FROM courses c LEFT JOIN profiles p ON p.userId = c.ownerId"
+            " WHERE c.id = ?", (_course_id,)).fetchone()
+        if row is None:
+            print("course {0} is not found".format(_course_id))
+            continue
+        _course_info = dict(zip(
+            ("id", "name", "section", "courseState", "ownerId"), row[:5]))
+        _teacher_names = ""
+        for (_full_name,) in conn.execute(
+                "SELECT fullName FROM teachers WHERE courseId = ?", (_course_id,)):
+            _teacher_names += "/" + str(_full_name)
+        print_course_info(_course_info,
+                          {"emailAddress": row[5], "name": {"fullName": row[6]}},
+                          _teacher_names)
+        if options["detail"]:
+            print("Enrolled user lists...")
+            print_users([[(_email or "")[0:10], _full_name] for _email, _full_name
+                         in conn.execute(
+                             "SELECT emailAddress, fullName FROM students"
+                             " WHERE courseId = ?", (_course_id,))])
+            print("Inviting user lists...")
+            print_users([[(_email or "")[0:10], _full_name] for _email, _full_name
+                         in conn.execute(
+                             "SELECT p.emailAddress, p.fullName FROM invitations i"
+                             " JOIN profiles p ON p.userId = i.userId"
+                             " WHERE i.courseId = ?", (_course_id,))])
+    conn.close()
+
+
+def print_course_info(_course_info, _teacher_info, _teacher_names):
+    """print_course_info(_course_info, _teacher_info, _teacher_names)
+    """
+    print("course_id: {}".format(_course_info.get("id")))
+    print("name    : {}".format(_course_info.get("name")))
+    print("section : {}".format(_course_info.get("section")))
+    print("status  : {}".format(_course_info.get("courseState")))
+    print("ownerId  : {}".format(_course_info.get("ownerId")))
+    print("owner : {}({})".format(_teacher_info.get(
+        "emailAddress"), _teacher_info.get("name", {}).get("fullName")))
+    print("teacher : {}".format(_teacher_names))
+
+
+def print_users(results):
+    """print_users(results)
+    """
+    if results:
+        for result in sorted(results):
+            print("{},{}".format(result[0], result[1]))
 
 
 def info_user(_user_id):
@@ -717,14 +1439,7 @@ def enrolled_students(_course_id):
                 break
         else:
             break
-    results = []
-    if user_ids:
-        worker = partial(info_classroom_proc, creds_classroom=creds_classroom)
-        with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-            for result in tqdm(
-                    executor.map(worker, user_ids), total=len(user_ids)):
-                results.append(result)
-    return results
+    return profile_summaries(user_ids)
 
 
 def invited_students(_course_id):
@@ -743,24 +1458,404 @@ def invited_students(_course_id):
                 break
         else:
             break
+    return profile_summaries(user_ids)
+
+
+def profile_summaries(user_ids):
+    """profile_summaries(user_ids)
+    """
+    get_profiles(user_ids)
     results = []
+    for user_id in user_ids:
+        _user_info = user_profiles.get(user_id)
+        if _user_info:
+            results.append([_user_info.get("emailAddress")[0:10],
+                            _user_info.get("name").get("fullName")])
+    return results
+
+
+def get_profiles(user_ids):
+    """get_profiles(user_ids)
+    """
+    # 取得済み(user_profiles にキャッシュ済み)の profile と重複を除いてバッチで取得
+    user_ids = [user_id for user_id in dict.fromkeys(user_ids)
+                if user_id and user_id not in user_profiles]
     if user_ids:
-        worker = partial(info_classroom_proc, creds_classroom=creds_classroom)
-        with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-            for result in tqdm(
-                    executor.map(worker, user_ids), total=len(user_ids)):
-                results.append(result)
+        calls = [("userProfiles", "get", {"userId": user_id})
+                 for user_id in user_ids]
+        for user_id, (_user_info, _code) in zip(user_ids, batch_execute(calls)):
+            if _user_info:
+                user_profiles[user_id] = _user_info
+            elif _code == 403:  # 403 is unauthorized
+                print("Not Authorized {0}".format(user_id))
+            else:
+                print("userProfile {0} error({1})".format(user_id, _code))
+    return user_profiles
+
+
+def batch_execute(calls, key=None):
+    """batch_execute(calls, key=None)
+    """
+    # BATCH_SIZE 件ずつ batch request にまとめ、各 batch をレート制限下で並列実行する。
+    # key(call) を指定した場合は courseId の shard ごとに batch を分ける。
+    # 戻り値は calls と同じ順序の [response, error_code] のリスト。
+    # 429 / 5xx で失敗した call だけを batch にまとめ直し、指数バックオフの後に
+    # MAX_RETRIES 回まで再実行する。
+    results = [[None, None] for _ in calls]
+    targets = list(range(len(calls)))
+    for retries in range(MAX_RETRIES + 1):
+        if retries:
+            # exponential backoff (per-minute quota の回復を待つ)
+            time.sleep(min(2 ** retries, 32) / 2)
+        shards = {}
+        for i in targets:
+            shards.setdefault(get_shard(key(calls[i])) if key else 0, []).append(i)
+        chunks = [(indexes[i:i + BATCH_SIZE],)
+                  for indexes in shards.values()
+                  for i in range(0, len(indexes), BATCH_SIZE)]
+        for index, result in tqdm(
+                run_parallel(batch_proc,
+                             [([calls[i] for i in chunk],) for (chunk,) in chunks],
+                             cost=lambda task: len(task[0]),
+                             key=(lambda task: key(task[0][0])) if key else None,
+                             congested=lambda result: any(
+                                 is_congested(_code) for _, _code in result)),
+                total=len(chunks)):
+            for i, _result in zip(chunks[index][0], result):
+                results[i] = _result
+        targets = [i for i in targets if is_congested(results[i][1])]
+        if not targets:
+            break
+        run_metrics["retries"] += len(targets)
     return results
 
 
-def info_classroom_proc(user_id, creds_classroom):
-    """info_classroom_proc(user_id, creds_classroom)
+def is_congested(_code):
+    """is_congested(_code)
+    """
+    # 429 is RESOURCE_EXHAUSTED(quota), 5xx is backend error
+    return _code is not None and (_code == 429 or _code >= 500)
+
+
+def run_parallel(worker, tasks, cost=None, key=None, congested=None):
+    """run_parallel(worker, tasks, cost=None, key=None, congested=None)
+    """
+    # tasks: worker に渡す引数タプルのイテラブル(creds_classroom は自動で付与)。
+    # key(task) の courseId から担当 shard(管理者アカウント)を決め、その shard の
+    # limiter で cost(task) 件分のリクエストを待ってから、shard の controller が
+    # 許す並列数まで投入し、完了した順に (index, result) を返す。
+    # 429 / 5xx で失敗した task は並列数を下げたうえで MAX_RETRIES 回まで再投入する。
+    tasks = enumerate(tasks)
+    pending = {}
+    retry_tasks = deque()
+    inflight = [0] * len(shard_creds)
+    held = None
+    exhausted = False
+    # serve では常駐のプロセスプールを使い回す
+    executor = shared_executor or start_pool()
+    try:
+        while True:
+            while True:
+                if held is None:
+                    # バックオフの待ち時刻(not before)を過ぎた再試行を優先する
+                    _now = time.monotonic()
+                    _ready = next((_retry for _retry in retry_tasks
+                                   if _retry[4] <= _now), None)
+                    if _ready is not None:
+                        retry_tasks.remove(_ready)
+                        held = _ready[:4]
+                    elif not exhausted:
+                        try:
+                            index, task = next(tasks)
+                            held = (index, task,
+                                    get_shard(key(task)) if key else 0, 0)
+                        except StopIteration:
+                            exhausted = True
+                if held is None or \
+                        inflight[held[2]] >= shard_controllers[held[2]].limit():
+                    break
+                index, task, _shard, retries = held
+                held = None
+                shard_limiters[_shard].acquire(cost(task) if cost else 1)
+                future = executor.submit(captured_proc, worker, *task,
+                                         creds_classroom=shard_creds[_shard])
+                pending[future] = (index, task, _shard, retries, time.monotonic())
+                inflight[_shard] += 1
+                run_metrics["tasks"] += 1
+            # 待ち中の再試行があれば、その時刻までに完了した分を回収する
+            # (時刻を過ぎた再試行は並列数の空きを待つ)
+            _now = time.monotonic()
+            _waits = [_retry[4] - _now for _retry in retry_tasks if _retry[4] > _now]
+            _timeout = min(_waits) if _waits else None
+            if not pending:
+                if not retry_tasks:
+                    break
+                time.sleep(_timeout or 0)
+                continue
+            done, _ = wait(pending, timeout=_timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, task, _shard, retries, submitted = pending.pop(future)
+                inflight[_shard] -= 1
+                _error = future.exception()
+                if _error is not None:
+                    print(getattr(_error, "worker_output", ""), end="")
+                    _code = getattr(getattr(_error, "resp", None), "status", None)
+                    if is_congested(int(_code or 0)) and retries < MAX_RETRIES:
+                        shard_controllers[_shard].on_congestion()
+                        run_metrics["retries"] += 1
+                        # exponential backoff: 待ち時刻を付けて再投入の列に戻す
+                        retry_tasks.append((index, task, _shard, retries + 1,
+                                            time.monotonic()
+                                            + min(2 ** (retries + 1), 32) / 2))
+                        continue
+                    raise _error
+                result, _output = future.result()
+                print(_output, end="")
+                if congested and congested(result):
+                    shard_controllers[_shard].on_congestion()
+                else:
+                    shard_controllers[_shard].on_success(
+                        time.monotonic() - submitted)
+                yield index, result
+    finally:
+        if executor is not shared_executor:
+            executor.shutdown()
+
+
+def start_pool():
+    """start_pool()
+    """
+    # worker プロセスは最初の submit でまとめて fork される。tasks の generator
+    # (list_courses)がページングのスレッドを起こす前に fork を済ませておく
+    # (スレッドが httplib2 / ssl / queue のロックを持ったまま fork すると deadlock しうる)。
+    executor = ProcessPoolExecutor(max_workers=max_concurrency * len(shard_creds))
+    executor.submit(int).result()
+    return executor
+
+
+def captured_proc(worker, *args, **kwargs):
+    """captured_proc(worker, *args, **kwargs)
+    """
+    # worker の print は worker プロセスの stdout に出るため、serve では client に届かない。
+    # 出力を捕まえて result と一緒に返し、親プロセス(run_parallel)で表示する。
+    _output = io.StringIO()
+    try:
+        with redirect_stdout(_output):
+            return worker(*args, **kwargs), _output.getvalue()
+    except Exception as _e:
+        _e.worker_output = _output.getvalue()
+        raise
+
+
+class ConcurrencyController:
+    """ConcurrencyController(initial, maximum, minimum=1)
+    """
+    # AIMD: 429 / 5xx がなく latency が健全(観測した最小値の 2 倍未満)な間は
+    # 1 RTT あたり 1 ずつ並列数を増やし、429 / 5xx では半分に減らす
+
+    def __init__(self, initial, maximum, minimum=1):
+        self.window = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.peak = self.window
+        self.latency = None
+        self.base_latency = None
+        self.decreased = 0.0
+
+    def limit(self):
+        """limit()
+        """
+        return max(self.minimum, int(self.window))
+
+    def on_success(self, latency):
+        """on_success(latency)
+        """
+        if self.latency is None:
+            self.latency = self.base_latency = latency
+        self.latency = 0.8 * self.latency + 0.2 * latency
+        self.base_latency = min(self.base_latency, latency)
+        if self.latency < 2 * self.base_latency:
+            self.window = min(self.maximum, self.window + 1 / self.window)
+            self.peak = max(self.peak, self.window)
+
+    def on_congestion(self):
+        """on_congestion()
+        """
+        # 同じ RTT 内に返ってきた失敗で何度も半減させない
+        now = time.monotonic()
+        if now - self.decreased > (self.latency or 0):
+            self.window = max(self.minimum, self.window / 2)
+            self.decreased = now
+
+
+def print_metrics():
+    """print_metrics()
+    """
+    if run_metrics["tasks"]:
+        print("metrics: tasks={0} retries={1} elapsed={2:.1f}s".format(
+            run_metrics["tasks"], run_metrics["retries"],
+            time.monotonic() - run_metrics["started"]))
+        for _shard, controller in enumerate(shard_controllers):
+            print("  shard {0}: concurrency={1} (peak {2}, max {3})".format(
+                _shard, controller.limit(), int(controller.peak),
+                controller.maximum))
+
+
+def get_service(creds_classroom):
+    """get_service(creds_classroom)
+    """
+    # worker プロセスごとに service(discovery document と HTTP 接続)を使い回す。
+    # creds は task ごとに pickle されて届くため refresh_token で識別する。
+    # httplib2 の接続はスレッド間で共有できないため、スレッドごとに保持する。
+    _services = getattr(_worker_services, "services", None)
+    if _services is None:
+        _services = _worker_services.services = {}
+    _key = getattr(creds_classroom, "refresh_token", None)
+    if _key not in _services:
+        _services[_key] = build("classroom", "v1", credentials=creds_classroom)
+    return _services[_key]
+
+
+def get_shard(_course_id):
+    """get_shard(_course_id)
+    """
+    if len(shard_creds) == 1 or not _course_id:
+        return 0
+    return shard_ring.get(_course_id)
+
+
+def in_shard(_key):
+    """in_shard(_key)
+    """
+    # --shard i/N: courseId の stable_hash で全体を N 分割し、i 番目だけを処理する。
+    # 同じ coursesID とオプションなら、どのホストで実行しても同じ分割になる。
+    if not options.get("shard"):
+        return True
+    _index, _count = options["shard"]
+    return stable_hash(_key) % _count == _index
+
+
+def shard_path(_path, _shard):
+    """shard_path(_path, _shard)
+    """
+    _root, _ext = os.path.splitext(_path)
+    return "{0}.shard{1}of{2}{3}".format(_root, _shard[0], _shard[1], _ext)
+
+
+def shard_enrollments(dropped):
+    """shard_enrollments(dropped)
+    """
+    # enroll --shard: この slice のコースへの登録だけを残す(キーは courseId、
+    # 未作成のクラスは class code)。戻り値は slice 内の削除分。
+    for class_code in list(enroll_users.keys()):
+        if not in_shard(course_table.course_id(class_code)):
+            del enroll_users[class_code]
+    # enroll_users を書き換えたため serve の読み込みキャッシュを無効にする
+    data_cache.clear()
+    return [(class_code, user_id) for class_code, user_id in dropped
+            if in_shard(course_table.course_id(class_code))]
+
+
+def merge_shards(_shard_files, _output_file):
+    """merge_shards(_shard_files, _output_file)
+    """
+    # 各 shard の出力を順に連結する。先頭行(csv の見出し)は最初の shard のものだけを残す。
+    header = None
+    _rows = 0
+    with open(_output_file, "w") as _out:
+        for _shard_file in _shard_files:
+            if not os.path.exists(_shard_file):
+                print("{0} is not found, skip".format(_shard_file))
+                continue
+            with open(_shard_file, "r") as _f:
+                for _line_no, line in enumerate(_f):
+                    if _line_no == 0:
+                        if header is None:
+                            header = line
+                        elif line == header:
+                            continue
+                    _out.write(line)
+                    _rows += 1
+    print("merged {0} files ({1} lines) into {2}".format(
+        len(_shard_files), _rows, _output_file))
+
+
+def stable_hash(_key):
+    """stable_hash(_key)
+    """
+    # hash() はプロセスごとに seed が変わるため、実行間で不変な md5 を使う
+    return int(hashlib.md5(str(_key).encode("UTF-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """HashRing(nodes, replicas=100)
     """
-    _service = build("classroom", "v1", credentials=creds_classroom)
-    results = _service.userProfiles().get(userId=user_id).execute()
-    name = results.get("name").get("fullName")
-    student_id = results.get("emailAddress")[0:10]
-    return [student_id, name]
+    # consistent hashing: shard の増減で移動する courseId を最小限に抑える
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((stable_hash("{0}#{1}".format(node, i)), node)
+                           for node in nodes for i in range(replicas))
+        self.hashes = [_hash for _hash, _ in self.ring]
+
+    def get(self, _key):
+        """get(_key)
+        """
+        index = bisect.bisect(self.hashes, stable_hash(_key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class RateLimiter:
+    """RateLimiter(rate)
+    """
+    # token bucket: 平均 rate requests/sec を超えないよう acquire で待機する
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        # list_courses のページングスレッドからも呼ばれる
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        """acquire(count=1)
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.rate,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # batch 1 回分(count)が rate を超える場合は前借りを許す
+                if self.tokens >= min(count, self.rate):
+                    self.tokens -= count
+                    return
+                _wait = (min(count, self.rate) - self.tokens) / self.rate
+            time.sleep(_wait)
+
+
+def batch_proc(calls, creds_classroom):
+    """batch_proc(calls, creds_classroom)
+    """
+    # calls: (resource, method, kwargs) のリスト
+    #   e.g. ("courses.teachers", "list", {"courseId": course_id})
+    # HttpRequest はプロセス間で受け渡せないため、worker 側で組み立てる。
+    _service = get_service(creds_classroom)
+    results = [[None, None] for _ in calls]
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            results[int(request_id)][1] = int(exception.resp.status)
+        else:
+            results[int(request_id)][0] = response
+
+    batch = _service.new_batch_http_request(callback=callback)
+    for index, (_resource, _method, _kwargs) in enumerate(calls):
+        _target = _service
+        for _name in _resource.split("."):
+            _target = getattr(_target, _name)()
+        batch.add(getattr(_target, _method)(**_kwargs), request_id=str(index))
+    batch.execute()
+    return results
 
 
 def crawl_classroom():
@@ -768,63 +1863,181 @@ def crawl_classroom():
     """
     course_ids = []
     owner_ids = []
-    for _class_code, _course_id in course_lists.items():
+    for record in course_table.created():
+        if not in_shard(record.course_id):
+            continue
         if options["debug"]:
-            print(_class_code, _course_id,
-                  course_names[_class_code], course_owners[_class_code])
-        course_ids.append(_course_id)
-        owner_ids.append(course_owners[_class_code])
-    results = []
-    if course_ids:
-        worker = partial(crawl_classroom_proc, creds_classroom=creds_classroom)
-        with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-            for result in tqdm(executor.map(worker, course_ids, owner_ids),
-                               total=len(course_ids)):
-                results.append(result)
-    if results:
+            print(record.class_code, record.course_id, record.name, record.owner)
+        course_ids.append(record.course_id)
+        owner_ids.append(record.owner)
+    if options["watch"]:
+        watch_classroom(course_ids, owner_ids)
+        return
+    if options["fromSnapshot"]:
+        results = crawl_classroom_snapshot(course_ids)
+    else:
+        results = run_largest_first(crawl_classroom_proc,
+                                    list(zip(course_ids, owner_ids)), "crawl")
+    # --shard: コースが割り当たらなかった shard も見出しだけの出力を書く(merge 用)
+    if results or options["shard"]:
         with open(options["outputCsv"], "w") as _f:
             writer = csv.writer(_f, lineterminator="\n")
             # csv indexes
-            writer.writerow(
-                [
-                    "classCode",
-                    "SubjectName",
-                    "Section",
-                    "teacher",
-                    "emailAddress",
-                    "total",
-                    "enroled",
-                    "invited",
-                    "state"
-                ]
-            )
+            writer.writerow(crawl_header())
             for result in results:
-                _class_code = class_codes[result[0]]
-                writer.writerow(
-                    [
-                        _class_code,
-                        course_names[_class_code],
-                        result[3],
-                        class_teachers[_class_code],
-                        course_owners[_class_code],
-                        int(result[1] + result[2]),
-                        result[1],
-                        result[2],
-                        result[4]
-                    ]
-                )
+                writer.writerow(crawl_row(result))
+
+
+def crawl_header():
+    """crawl_header()
+    """
+    return [
+        "classCode",
+        "SubjectName",
+        "Section",
+        "teacher",
+        "emailAddress",
+        "total",
+        "enroled",
+        "invited",
+        "state"
+    ]
+
+
+def crawl_row(result):
+    """crawl_row(result)
+    """
+    record = course_table.by_id[result[0]]
+    return [
+        record.class_code,
+        record.name,
+        result[3],
+        record.teacher_names,
+        record.owner,
+        int(result[1] + result[2]),
+        result[1],
+        result[2],
+        result[4]
+    ]
+
+
+def watch_classroom(course_ids, owner_ids):
+    """watch_classroom(course_ids, owner_ids)
+    """
+    # crawl --watch: interval 秒ごとに、updateTime が変わったコース、直近で変化があった
+    # コース(hot)、最も長く確認していないコースの一部(watchSweep)だけを数え直し、
+    # 登録数 / 招待数が変わった行だけを差分付きで出力する(outputCsv が "-" なら stdout)
+    _interval = float(options["watch"])
+    _state_file = (options["outputCsv"] if options["outputCsv"] != "-"
+                   else "crawl") + ".watch.json"
+    state = {}
+    if os.path.exists(_state_file):
+        with open(_state_file, "r") as _f:
+            state = json.load(_f)
+    owners = dict(zip(course_ids, owner_ids))
+    _first = True
+    try:
+        while True:
+            started = time.monotonic()
+            watch_cycle(course_ids, owners, state, _first)
+            _first = False
+            with open(_state_file + ".tmp", "w") as _f:
+                json.dump(state, _f)
+            os.replace(_state_file + ".tmp", _state_file)
+            time.sleep(max(0.0, _interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        print("watch stopped")
+
+
+def watch_cycle(course_ids, owners, state, _first):
+    """watch_cycle(course_ids, owners, state, _first)
+    """
+    update_times = {course.get("id"): course.get("updateTime") for course in list_courses(
+        None, fields="nextPageToken,courses(id,updateTime)")}
+    now = time.time()
+    targets = [_course_id for _course_id in course_ids
+               if _course_id not in state
+               or state[_course_id]["updateTime"] != update_times.get(_course_id)
+               or state[_course_id]["hot"] > 0]
+    _targets = set(targets)
+    stale = sorted((_course_id for _course_id in course_ids
+                    if _course_id not in _targets),
+                   key=lambda _course_id: state[_course_id]["checked"])
+    targets += stale[:math.ceil(len(course_ids) * watch_sweep)]
+    results = run_largest_first(
+        crawl_classroom_proc,
+        [(_course_id, owners[_course_id]) for _course_id in targets],
+        "crawl") if targets else []
+    _timestamp = time.strftime("%Y-%m-%dT%H:%M:%S")
+    rows = []
+    for result in results:
+        _course_id = result[0]
+        _previous = state.get(_course_id, {})
+        _enrolled_delta = result[1] - _previous.get("enrolled", 0)
+        _invited_delta = result[2] - _previous.get("invited", 0)
+        # 初めて見たコースは出力するが hot にはしない(state がないと全件を数え直し続けるため)
+        changed = (_course_id in state and (_enrolled_delta or _invited_delta
+                                            or result[4] != _previous.get("state")))
+        state[_course_id] = {
+            "updateTime": update_times.get(_course_id),
+            "enrolled": result[1],
+            "invited": result[2],
+            "state": result[4],
+            "checked": now,
+            "hot": WATCH_HOT_CYCLES if changed else max(0, _previous.get("hot", 0) - 1),
+        }
+        if changed or not _previous:
+            rows.append([_timestamp] + crawl_row(result)
+                        + [_enrolled_delta, _invited_delta])
+    if options["outputCsv"] == "-":
+        _f = sys.stdout
+    else:
+        _new_file = not os.path.exists(options["outputCsv"])
+        _f = open(options["outputCsv"], "a")
+    writer = csv.writer(_f, lineterminator="\n")
+    if (_f is sys.stdout and _first) or (_f is not sys.stdout and _new_file):
+        # csv indexes
+        writer.writerow(["timestamp"] + crawl_header()
+                        + ["enroledDelta", "invitedDelta"])
+    writer.writerows(rows)
+    if _f is not sys.stdout:
+        _f.close()
+    print("{0} watch: {1}/{2} courses checked, {3} changed".format(
+        _timestamp, len(targets), len(course_ids), len(rows)), file=sys.stderr)
 
 
 def crawl_classroom_proc(_course_id, _owner_id, creds_classroom):
     """crawl_classroom_proc(_course_id, _owner_id, creds_classroom)
     """
-    _service = build("classroom", "v1", credentials=creds_classroom)
+    # students().list / invitations().list / courses().get の 3 系列は互いに独立なので、
+    # worker 内のスレッドで同時に発行し、1 コースの所要時間を最も長い系列に抑える。
+    # 件数だけが必要なため fields で id のみを返させる。
+    global _worker_threads
+    if _worker_threads is None:
+        _worker_threads = ThreadPoolExecutor(max_workers=3)
+    _students = _worker_threads.submit(count_students, _course_id, creds_classroom)
+    _invited = _worker_threads.submit(count_invitations, _course_id, creds_classroom)
+    _course = _worker_threads.submit(get_course_state, _course_id, creds_classroom)
+    total_enrolled, students_pages = _students.result()
+    total_invited, invited_pages = _invited.result()
+    _course_info = _course.result()
+    return [_course_id, total_enrolled, total_invited, _course_info.get("section"), _course_info.get("courseState"),
+            1 + students_pages + invited_pages]
+
+
+def count_students(_course_id, creds_classroom):
+    """count_students(_course_id, creds_classroom)
+    """
+    _service = get_service(creds_classroom)
     page_token = None
     total_enrolled = 0
+    pages = 0
     while True:
         try:
             _course_students = _service.courses().students().list(
-                pageSize=0, courseId=_course_id, pageToken=page_token).execute()
+                pageSize=0, courseId=_course_id, pageToken=page_token,
+                fields="students(userId),nextPageToken").execute()
+            pages += 1
             if "students" in _course_students:
                 total_enrolled += len(_course_students.get("students"))
             page_token = _course_students.get('nextPageToken', None)
@@ -837,11 +2050,21 @@ def crawl_classroom_proc(_course_id, _owner_id, creds_classroom):
                 break
             else:
                 raise
+    return total_enrolled, pages
+
+
+def count_invitations(_course_id, creds_classroom):
+    """count_invitations(_course_id, creds_classroom)
+    """
+    _service = get_service(creds_classroom)
     page_token = None
     total_invited = 0
+    pages = 0
     while True:
         _invite_students = _service.invitations().list(
-            courseId=_course_id, pageSize=0, pageToken=page_token).execute()
+            courseId=_course_id, pageSize=0, pageToken=page_token,
+            fields="invitations(id),nextPageToken").execute()
+        pages += 1
         if "invitations" in _invite_students:
             total_invited += len(_invite_students.get("invitations"))
         # page_token の更新が抜けており、常に1ページ目のみ取得するバグを修正。
@@ -849,8 +2072,209 @@ def crawl_classroom_proc(_course_id, _owner_id, creds_classroom):
         page_token = _invite_students.get('nextPageToken', None)
         if not page_token:
             break
-    _course_info = _service.courses().get(id=_course_id).execute()
-    return [_course_id, total_enrolled, total_invited, _course_info.get("section"), _course_info.get("courseState")]
+    return total_invited, pages
+
+
+def get_course_state(_course_id, creds_classroom):
+    """get_course_state(_course_id, creds_classroom)
+    """
+    _service = get_service(creds_classroom)
+    return _service.courses().get(id=_course_id, fields="section,courseState").execute()
+
+
+def run_largest_first(worker, tasks, _kind):
+    """run_largest_first(worker, tasks, _kind)
+    """
+    # tasks[i][0] は courseId。前回の実行で記録したページ数(なければ登録者数)から
+    # 見積もったコストの大きい順に投入する(LPT)。空いた worker が共有キューから
+    # 次の task を取るため、大きなコースが最後に残って全体の完了を遅らせることがない。
+    # 戻り値は tasks と同じ順序で、各 result の末尾は実際に取得したページ数。
+    load_course_costs()
+    order = sorted(range(len(tasks)),
+                   key=lambda i: estimate_cost(tasks[i][0], _kind), reverse=True)
+    results = [None] * len(tasks)
+    for index, result in tqdm(
+            run_parallel(worker, [tasks[i] for i in order],
+                         # limiter には見積もりページ数(crawl は最低 3 request)を渡す
+                         cost=lambda task: max(3 if _kind == "crawl" else 1,
+                                               math.ceil(estimate_cost(task[0], _kind))),
+                         key=lambda task: task[0]),
+            total=len(tasks)):
+        results[order[index]] = result
+        _cost = course_costs.setdefault(result[0], {})
+        _cost[_kind] = result[-1]
+        if _kind == "crawl":
+            _cost["students"] = result[1]
+    save_course_costs()
+    return results
+
+
+def estimate_cost(_course_id, _kind):
+    """estimate_cost(_course_id, _kind)
+    """
+    _cost = course_costs.get(_course_id, {})
+    if _kind in _cost:
+        return _cost[_kind]
+    if "students" in _cost:
+        # students().list returns 30 users / page by default
+        return 1 + _cost["students"] / 30
+    return 1
+
+
+def load_course_costs():
+    """load_course_costs()
+    """
+    if not course_costs and os.path.exists(cost_file):
+        with open(cost_file, "r") as _f:
+            course_costs.update(json.load(_f))
+    return course_costs
+
+
+def save_course_costs():
+    """save_course_costs()
+    """
+    with open(cost_file + ".tmp", "w") as _f:
+        json.dump(course_costs, _f)
+    os.replace(cost_file + ".tmp", cost_file)
+
+
+def crawl_classroom_snapshot(course_ids):
+    """crawl_classroom_snapshot(course_ids)
+    """
+    conn = snapshot_connect()
+    results = []
+    for _course_id in course_ids:
+        row = conn.execute(
+            "SELECT c.section, c.courseState,"
+            " (SELECT count(*) FROM students s WHERE s.courseId = c.id),"
+            " (SELECT count(*) FROM invitations i WHERE i.courseId = c.id)"
+            " FROM courses c WHERE c.id = ?", (_course_id,)).fetchone()
+        if row is None:
+            print("Course Not Found {0}".format(_course_id))
+            results.append([_course_id, 0, 0, None, None])
+        else:
+            results.append([_course_id, row[2], row[3], row[0], row[1]])
+    conn.close()
+    return results
+
+
+def snapshot_classroom():
+    """snapshot_classroom()
+    """
+    # 全コース(全 state)と各コースの teachers / students / invitations、owner 等の
+    # profile を並列・ページングで取得し SQLite に保存する。
+    # lists / crawl / info は --from-snapshot でこの db を参照してオフラインで実行できる。
+    _snapshot_file = options["snapshotFile"]
+    _tmp_file = _snapshot_file + ".tmp"
+    if os.path.exists(_tmp_file):
+        os.remove(_tmp_file)
+    conn = sqlite3.connect(_tmp_file)
+    conn.executescript("""
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE courses (id TEXT PRIMARY KEY, name TEXT, section TEXT,
+            ownerId TEXT, enrollmentCode TEXT, courseState TEXT, updateTime TEXT);
+        CREATE TABLE teachers (courseId TEXT, userId TEXT, emailAddress TEXT,
+            fullName TEXT);
+        CREATE TABLE students (courseId TEXT, userId TEXT, emailAddress TEXT,
+            fullName TEXT);
+        CREATE TABLE invitations (courseId TEXT, userId TEXT, role TEXT);
+        CREATE TABLE profiles (userId TEXT PRIMARY KEY, emailAddress TEXT,
+            fullName TEXT);
+        CREATE INDEX teachers_course ON teachers (courseId);
+        CREATE INDEX students_course ON students (courseId);
+        CREATE INDEX invitations_course ON invitations (courseId);
+    """)
+    owner_ids = []
+    user_ids = []
+
+    def snapshot_tasks():
+        # courses().list のページングと各コースの名簿取得を重ねる
+        for course in list_courses(None):
+            conn.execute(
+                "INSERT OR REPLACE INTO courses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (course.get("id"), course.get("name"), course.get("section"),
+                 course.get("ownerId"), course.get("enrollmentCode"),
+                 course.get("courseState"), course.get("updateTime")))
+            owner_ids.append(course.get("ownerId"))
+            yield (course.get("id"),)
+
+    for index, (_teachers, _students, _invitations) in tqdm(
+            run_parallel(snapshot_proc, snapshot_tasks(),
+                         # teachers / students / invitations の list (各 1 ページ以上)
+                         cost=lambda task: 3,
+                         key=lambda task: task[0])):
+        conn.executemany("INSERT INTO teachers VALUES (?, ?, ?, ?)", _teachers)
+        conn.executemany("INSERT INTO students VALUES (?, ?, ?, ?)", _students)
+        conn.executemany("INSERT INTO invitations VALUES (?, ?, ?)", _invitations)
+        # 名簿から得られた profile は userProfiles().get を省略する
+        for _, _user_id, _email, _full_name in _teachers + _students:
+            user_profiles.setdefault(_user_id, {
+                "emailAddress": _email, "name": {"fullName": _full_name}})
+        user_ids += [_user_id for _, _user_id, _ in _invitations]
+    print("total Courses: {} ".format(len(owner_ids)))
+    get_profiles(owner_ids + user_ids)
+    conn.executemany(
+        "INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)",
+        [(_user_id, _profile.get("emailAddress"),
+          _profile.get("name", {}).get("fullName"))
+         for _user_id, _profile in user_profiles.items()])
+    conn.execute("INSERT INTO meta VALUES ('createTime', ?)",
+                 (time.strftime("%Y-%m-%dT%H:%M:%S"),))
+    conn.commit()
+    conn.close()
+    os.replace(_tmp_file, _snapshot_file)
+    print("snapshot saved: {}".format(_snapshot_file))
+
+
+def snapshot_proc(_course_id, creds_classroom):
+    """snapshot_proc(_course_id, creds_classroom)
+    """
+    _service = get_service(creds_classroom)
+    rows = []
+    for _resource, _key, _fields in (
+            (_service.courses().teachers(), "teachers",
+             "userId,profile(emailAddress,name/fullName)"),
+            (_service.courses().students(), "students",
+             "userId,profile(emailAddress,name/fullName)"),
+            (_service.invitations(), "invitations", "userId,role")):
+        _rows = []
+        page_token = None
+        while True:
+            try:
+                results = _resource.list(
+                    courseId=_course_id, pageSize=0, pageToken=page_token,
+                    fields="nextPageToken,{0}({1})".format(_key, _fields)
+                ).execute()
+            except HttpError as _e:
+                error = json.loads(_e.content).get("error")
+                if error.get("code") == 404:  # 404 is not found
+                    print("Course Not Found {0}".format(_course_id))
+                    break
+                else:
+                    raise
+            for member in results.get(_key, []):
+                if _key == "invitations":
+                    _rows.append((_course_id, member.get("userId"),
+                                  member.get("role")))
+                else:
+                    _profile = member.get("profile", {})
+                    _rows.append((_course_id, member.get("userId"),
+                                  _profile.get("emailAddress"),
+                                  _profile.get("name", {}).get("fullName")))
+            page_token = results.get('nextPageToken', None)
+            if not page_token:
+                break
+        rows.append(_rows)
+    return rows
+
+
+def snapshot_connect():
+    """snapshot_connect()
+    """
+    if not os.path.exists(options["fromSnapshot"]):
+        print("snapshot {0} is not found".format(options["fromSnapshot"]))
+        sys.exit(1)
+    return sqlite3.connect(options["fromSnapshot"])
 
 
 def get_course_id(_course_id=None):
@@ -860,25 +2284,22 @@ def get_course_id(_course_id=None):
         _course_id = options["courseId"]
     elif not _course_id:
         return None
-    return course_lists.get(_course_id, _course_id)
+    return course_table.course_id(_course_id)
 
 
 def get_classroom_stream():
     """get_classroom_stream()
     """
     course_ids = []
-    for _class_code, _course_id in course_lists.items():
-        print(_class_code, _course_id,
-              course_names[_class_code], course_owners[_class_code])
-        course_ids.append(_course_id)
-    results = []
-    if course_ids:
-        worker = partial(get_classroom_stream_proc, options=options, creds_classroom=creds_classroom)
-        with ProcessPoolExecutor(max_workers=MAX_PROCESS) as executor:
-            for result in tqdm(executor.map(worker, course_ids),
-                               total=len(course_ids)):
-                results.append(result)
-    if results:
+    for record in course_table.created():
+        if not in_shard(record.course_id):
+            continue
+        print(record.class_code, record.course_id, record.name, record.owner)
+        course_ids.append(record.course_id)
+    worker = partial(get_classroom_stream_proc, options=options)
+    results = run_largest_first(
+        worker, [(_course_id,) for _course_id in course_ids], "getStream")
+    if results or options["shard"]:
         with open(options["outputCsv"], "w") as _f:
             writer = csv.writer(_f, lineterminator="\n")
             # csv indexes
@@ -892,13 +2313,13 @@ def get_classroom_stream():
                 ]
             )
             for result in results:
-                _class_code = class_codes[result[0]]
+                record = course_table.by_id[result[0]]
                 writer.writerow(
                     [
-                        _class_code,
-                        course_names[_class_code],
-                        class_teachers[_class_code],
-                        course_owners[_class_code],
+                        record.class_code,
+                        record.name,
+                        record.teacher_names,
+                        record.owner,
                         result[1]
                     ]
                 )
@@ -907,12 +2328,14 @@ def get_classroom_stream():
 def get_classroom_stream_proc(_course_id, options, creds_classroom):
     """get_classroom_stream_proc(_course_id, options, creds_classroom)
     """
-    _service = build("classroom", "v1", credentials=creds_classroom)
+    _service = get_service(creds_classroom)
     page_token = None
     announcements = []
+    pages = 0
     while True:
         course_announcements = _service.courses().announcements().list(
             pageSize=0, courseId=_course_id, pageToken=page_token).execute()
+        pages += 1
         if "announcements" in course_announcements:
             announcements.append(course_announcements.get("announcements"))
         page_token = course_announcements.get('nextPageToken', None)
@@ -923,129 +2346,337 @@ def get_classroom_stream_proc(_course_id, options, creds_classroom):
         for announce in announcement:
             if re.search(options["keyword"], announce['text']):
                 result += announce['text'].replace('\n', '')
-    return [_course_id, result]
+    return [_course_id, result, pages]
 
 
-# main()
-# os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = './credentials.json'
-# max parallel requests for Google Classroom API
-# cf. https://developers.google.com/classroom/limits?hl=ja
+def run_command(argv=None):
+    """run_command(argv=None)
+    """
+    # 1 回分のサブコマンドを実行する(serve からは client の argv ごとに呼ばれる)
+    global exec_mode, options
+    exec_mode, options = parse_options(argv)
+    if exec_mode == "serve":
+        sys.exit("serve is already running")
+    # 管理者アカウントの組(--sharded)は serve の起動時に決まるため、要求ごとには変えられない
+    if serve_sharded is not None and exec_mode in (
+            "default", "enroll", "lists", "crawl", "getStream", "snapshot") \
+            and options["sharded"] != serve_sharded:
+        sys.exit("serve is running {0} --sharded; restart serve to change it".format(
+            "with" if serve_sharded else "without"))
+    resolve_paths()
+    course_rosters.clear()
+    run_metrics.update({"tasks": 0, "retries": 0, "started": time.monotonic()})
+    try:
+        dispatch_command()
+    finally:
+        print_metrics()
 
 
-if __name__ == "__main__":
-    MAX_PROCESS = 5
-    service = {}
-    class_subjects = {}
-    class_teachers = {}
-    class_sections = {}
-    user_emails = {}
-    enroll_users = {}
-    course_lists = {}
-    course_names = {}
-    course_owners = {}
-    class_codes = {}
+def resolve_paths():
+    """resolve_paths()
+    """
+    # config.ini のファイル名はカレントディレクトリ基準(serve では client 側)で解決する
+    global cost_file, enroll_state_file, registry_file
+    _cost_file = os.path.abspath(
+        inifile.get("user", "costFile", fallback="courseCosts.json"))
+    if _cost_file != cost_file:
+        course_costs.clear()
+    cost_file = _cost_file
+    enroll_state_file = os.path.abspath(
+        inifile.get("user", "enrollStateFile", fallback="enrollments.state.csv"))
+    registry_file = os.path.abspath(
+        inifile.get("user", "registryFile", fallback="coursesID.db"))
 
-    exec_mode, options = parse_options()
-    # print(exec_mode, options)
-    # load config.ini
-    inifile = configparser.ConfigParser()
-    inifile.read("./config.ini", "UTF-8")
-    adminUser = inifile.get("user", "adminUser")
-    admin_id = inifile.get("user", "adminId")
-    class_code_regex = inifile.get("user", 'classCodeRegex')
-    course_id_file = read_data()
-    if not options["dry-run"]:
-        file = open(course_id_file, "a")
-        csvWrite = csv.writer(file)
-    # Google Classroom API activation
-    if not options["dry-run"]:
-        # Classroom Management scope credentials
-        creds_classroom, service_classroom = api_init()
+
+def dispatch_command():
+    """dispatch_command()
+    """
+    read_data()
+    dropped = []
+    unchanged = set()
+    if exec_mode == "enroll" and options["since"]:
+        dropped, unchanged = enroll_delta(options["since"])
+    if exec_mode == "enroll" and options["shard"]:
+        dropped = shard_enrollments(dropped)
+    if options["dry-run"] and exec_mode in ('create', 'enroll', 'default'):
+        plan_job(dropped)
+        return
     if exec_mode in ('create', 'default'):
-        target = class_subjects
+        target = course_table.classes()
     elif exec_mode == "remove":
-        for course_id in options["courses"]:
-            print("removing.. {}".format(course_id), end="")
-            delete_classroom(course_id)
-            print("done")
-        sys.exit()
+        delete_classroom(options["courses"])
+        print("done")
+        return
     elif exec_mode == "unenroll":
-        delete_user(options["courses"], options["userId"])
+        delete_user(options["unenrollments"])
         print("done")
-        sys.exit()
+        return
     elif exec_mode == "lists":
         list_classroom()
-        sys.exit()
+        return
     elif exec_mode == "info":
         print("courses Information..")
         info_classroom(options["courses"])
-        sys.exit()
+        return
     elif exec_mode == "user":
         info_user(options["userId"])
-        sys.exit()
+        return
     elif exec_mode == "crawl":
         crawl_classroom()
-        sys.exit()
+        return
     elif exec_mode == "getStream":
         get_classroom_stream()
-        sys.exit()
+        return
+    elif exec_mode == "snapshot":
+        snapshot_classroom()
+        return
+    elif exec_mode == "registry":
+        registry_command()
+        return
+    elif exec_mode == "merge":
+        merge_shards(options["shardFiles"], options["outputCsv"])
+        return
     elif exec_mode in ('archive', 'active'):
         update_courses(options["courses"])
-        sys.exit()
+        return
     elif exec_mode == "owner":
         update_courses(options["courses"], options["owner"])
-        sys.exit()
+        return
     else:
-        target = course_lists
-    for class_code in target.keys():
-        course_id = course_lists[class_code] if class_code in course_lists else 0
+        target = course_table.created()
+    if not options["dry-run"]:
+        conn = registry_open()
+        # registry に登録済みのクラスは作成しない(--dry-run の plan では satisfied)
+        created = {_class_code for (_class_code,) in conn.execute(
+            "SELECT classCode FROM courses WHERE classCode IS NOT NULL")}
+    for record in target:
+        class_code = record.class_code
         if exec_mode in ('create', 'default'):
+            if not options["dry-run"] and class_code in created:
+                print("Class Code {0} is already created, skip".format(class_code))
+                continue
             print("creating..")
-            class_teacher = user_emails[class_teachers[class_code]]
-            class_subject = class_subjects[class_code] + "(" + class_code + ")"
-            classSection = class_sections[class_code]
+            class_teacher = user_emails[record.teacher_id]
+            class_subject = record.subject + "(" + class_code + ")"
+            classSection = record.section
+            course_id = 0
             if not options["dry-run"]:
                 course_id, enroll_code = create_classroom(
-                    class_subject, class_sections[class_code], class_teacher
+                    class_subject, record.section, class_teacher
                 )
                 if (course_id == 0):
                     continue
-                csvWrite.writerow(
-                    [class_code, course_id, class_subject,
-                        class_teacher, enroll_code]
-                )
+                registry_add(conn, [class_code, course_id, class_subject,
+                                    class_teacher, None, record.section,
+                                    None, enroll_code, None])
+                # all: 作成したコースにそのまま登録するため索引に追加
+                course_table.add(class_code, course_id=course_id, owner=class_teacher)
             print("Course    ID:{}".format(course_id))
             print("Class   Code:{}".format(class_code))
             print("Course  Name:{}".format(class_subject))
             print("Subject Name:{}".format(classSection))
             print("Lecturer    :{}".format(class_teacher))
-        if exec_mode in ('enroll', 'default'):
-            # add adminUser while users are added to a course
-            # if enrolling user's class code exist in class_code
-            # if options["debug"]:
-            #    print('enrollUsers:{0}'.format(enroll_users))
-            if class_code in enroll_users:
-                if options["debug"]:
-                    print('classCode:{}{}'.format(
-                        class_code, course_owners[class_code]))
-                class_teacher = course_owners[class_code]
-                # if invite foreign domain user, adminUser add to class
-                if (
-                    class_teacher != adminUser and class_teacher != admin_id
-                    and not options["dry-run"]
-                    and options["foreignDomain"]
-                ):
-                    add_admin_user(course_id)
-                print("Enrolling users.. ", end="")
-                if options["foreignDomain"]:
-                    invite_users(class_code)
-                else:
-                    create_users(class_code)
-                if (
-                    class_teacher != adminUser and class_teacher != admin_id
-                    and not options["dry-run"]
-                    and options["foreignDomain"]
-                ):
-                    delete_admin_user(course_id)
+    if exec_mode in ('enroll', 'default'):
+        # if enrolling user's class code exist in class_code
+        # if options["debug"]:
+        #    print('enrollUsers:{0}'.format(enroll_users))
+        applied = set(unchanged)
+        enroll_classes = [record for record in target
+                          if record.class_code in enroll_users and record.course_id]
+        # if invite foreign domain user, adminUser add to classes at once
+        # (skip courses owned by adminUser or already having adminUser as teacher;
+        #  --sharded では shard 0 以外の管理者が招待するため、所有者が adminUser でも確認する)
+        admin_courses = []
+        if options["foreignDomain"] and not options["dry-run"]:
+            admin_courses = add_admin_users(
+                [record.course_id for record in enroll_classes
+                 if record.owner not in (adminUser, admin_id)
+                 or get_shard(record.course_id) != 0])
+        for record in enroll_classes:
+            class_code = record.class_code
+            if options["debug"]:
+                print('classCode:{}{}'.format(class_code, record.owner))
+            print("Enrolling users.. ", end="")
+            if options["foreignDomain"]:
+                _applied = invite_users(class_code)
+            else:
+                _applied = create_users(class_code)
+            applied.update((class_code, user_id) for user_id in _applied)
+        # remove adminUser only from the classes added above
+        if admin_courses:
+            delete_admin_users(admin_courses)
+        if dropped and options["withDrop"]:
+            print("Unenrolling dropped users.. ")
+            delete_user([(user_id, class_code) for class_code, user_id in dropped])
+        # save applied enrollments as state for the next --since
+        if not options["dry-run"]:
+            save_enroll_state(applied)
     if not options["dry-run"]:
-        file.close()
+        conn.close()
+
+
+def init_api(_activate):
+    """init_api(_activate)
+    """
+    global creds_classroom, service_classroom, shard_creds
+    global shard_limiters, shard_controllers, shard_ring
+    # Google Classroom API activation
+    if _activate:
+        # Classroom Management scope credentials
+        creds_classroom, service_classroom = api_init(token_files[0])
+        shard_creds = [creds_classroom] + [api_init(_token_file)[0]
+                                           for _token_file in token_files[1:]]
+    else:
+        shard_creds = [None]
+    # quota は管理者アカウント単位のため shard ごとに limiter / controller を持つ
+    shard_limiters = [RateLimiter(query_per_sec) for _ in shard_creds]
+    shard_controllers = [ConcurrencyController(initial_concurrency, max_concurrency)
+                         for _ in shard_creds]
+    shard_ring = HashRing(range(len(shard_creds)))
+
+
+def serve(_socket_file):
+    """serve(_socket_file)
+    """
+    # 認証情報・プロセスプール(各 worker の service / HTTP 接続)・profile キャッシュ・
+    # 読み込み済み CSV を保持したまま、Unix socket で client からのサブコマンドを受け付ける
+    global shared_executor, serve_sharded
+    serve_sharded = options["sharded"]
+    if os.path.exists(_socket_file):
+        os.remove(_socket_file)
+    shared_executor = start_pool()
+    server = socketserver.UnixStreamServer(_socket_file, CommandHandler)
+    os.chmod(_socket_file, 0o600)
+    print("serving on {}".format(_socket_file))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(_socket_file)
+        shared_executor.shutdown()
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """CommandHandler
+    """
+    # request : {"argv": [...], "cwd": "..."} (1 行の JSON)
+    # response: {"out": "..."} を逐次返し、最後に {"exit": code}
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        writer = SocketWriter(self.wfile)
+        _exit_code = 0
+        _cwd = os.getcwd()
+        try:
+            os.chdir(request.get("cwd", _cwd))
+            with redirect_stdout(writer), redirect_stderr(writer):
+                run_command(request.get("argv", []))
+        except SystemExit as _e:
+            # docopt prints usage via SystemExit(message)
+            if isinstance(_e.code, str):
+                writer.write(_e.code + "\n")
+                _exit_code = 1
+            else:
+                _exit_code = _e.code or 0
+        except Exception:
+            writer.write(traceback.format_exc())
+            _exit_code = 1
+        finally:
+            os.chdir(_cwd)
+        try:
+            self.wfile.write((json.dumps({"exit": _exit_code}) + "\n").encode("UTF-8"))
+        except BrokenPipeError:
+            pass
+
+
+class SocketWriter:
+    """SocketWriter(wfile)
+    """
+    # stdout / stderr(tqdm) の出力を client へ転送する
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        """write(text)
+        """
+        if text:
+            self.wfile.write((json.dumps({"out": text}) + "\n").encode("UTF-8"))
+        return len(text)
+
+    def flush(self):
+        """flush()
+        """
+        self.wfile.flush()
+
+
+# main()
+# os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = './credentials.json'
+# max parallel requests for Google Classroom API
+# cf. https://developers.google.com/classroom/limits?hl=ja
+
+
+if __name__ == "__main__":
+    # max requests in a single batch request (API limit is 1000)
+    BATCH_SIZE = 50
+    # retry count for 429 / 5xx responses
+    MAX_RETRIES = 5
+    # crawl --watch: changed courses are rechecked for the next cycles
+    WATCH_HOT_CYCLES = 3
+    # courseStates values listed as separate partitions (list_courses)
+    COURSE_STATES = ("ACTIVE", "ARCHIVED", "PROVISIONED", "DECLINED", "SUSPENDED")
+    # pages(500 courses each) buffered between listing threads and workers
+    LIST_QUEUE_PAGES = 4
+    admin_ids = {}
+    user_emails = {}
+    enroll_users = {}
+    course_table = CourseTable()
+    user_profiles = {}
+    course_rosters = {}
+    course_costs = {}
+    data_cache = {}
+    run_metrics = {"tasks": 0, "retries": 0, "started": time.monotonic()}
+    shared_executor = None
+    serve_sharded = None
+
+    exec_mode, options = parse_options()
+    # print(exec_mode, options)
+    # load config.ini
+    inifile = configparser.ConfigParser()
+    inifile.read("./config.ini", "UTF-8")
+    adminUser = inifile.get("user", "adminUser")
+    admin_id = inifile.get("user", "adminId")
+    class_code_regex = inifile.get("user", 'classCodeRegex')
+    # Google Classroom API usage limit: 25 query / sec (default)
+    query_per_sec = inifile.getfloat("user", "queryPerSec", fallback=25)
+    # costFile: page counts of the previous crawl / get-stream (largest-first scheduling)
+    # enrollStateFile: enrollments applied by the last enroll (enroll --since)
+    # registryFile: course registry (created courses, replaces coursesID.csv)
+    # (resolved for each command by resolve_paths)
+    cost_file = None
+    enroll_state_file = None
+    registry_file = None
+    # crawl --watch: ratio of least recently checked courses rechecked per cycle
+    watch_sweep = inifile.getfloat("user", "watchSweep", fallback=0.05)
+    # in-flight requests are adjusted by AIMD between 1 and maxConcurrency
+    initial_concurrency = inifile.getint("user", "initialConcurrency", fallback=5)
+    max_concurrency = inifile.getint("user", "maxConcurrency", fallback=20)
+    # measured latency: about 1.5 sec / query (used by --dry-run plan)
+    query_latency = inifile.getfloat("user", "queryLatency", fallback=1.5)
+    # invitations by teacher are limited to 500 / day
+    invitation_quota = inifile.getint("user", "invitationQuota", fallback=500)
+    # tokenFiles: 管理者アカウントごとの token を列挙(先頭が adminUser のもの)
+    # e.g. tokenFiles=token.pickle,token_admin2.pickle,token_admin3.pickle
+    token_files = [_token_file.strip() for _token_file in inifile.get(
+        "user", "tokenFiles", fallback="token.pickle").split(",")]
+    if not options["sharded"]:
+        token_files = token_files[:1]
+    if exec_mode == "serve":
+        init_api(True)
+        serve(options["socket"])
+        sys.exit()
+    init_api(not options["dry-run"] and not options["fromSnapshot"]
+             and exec_mode not in ("merge", "registry"))
+    run_command()